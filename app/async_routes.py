@@ -0,0 +1,233 @@
+import asyncio
+from datetime import MAXYEAR, MINYEAR, date, datetime
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from quart import Quart, Response, jsonify, make_response, request
+
+from module_21_orm_2.homework.app.models import aio
+from module_21_orm_2.homework.app.models.book import SEARCH_LIMIT
+from module_21_orm_2.homework.app.models.cache import analytics_cache
+from module_21_orm_2.homework.app.models.catalogue import catalogue
+from module_21_orm_2.homework.app.models.migrations import init_database
+from module_21_orm_2.homework.app.serializers import json_responder
+from module_21_orm_2.homework.app.web import Validators, page_args
+
+# ASGI variant of the polling-heavy routes in routes.py, same URLs and responses:
+#   hypercorn module_21_orm_2.homework.app.async_routes:app
+# A request waiting on SQLite holds a coroutine instead of a worker thread.
+# Only the polled reads and single give/return are here. Debtors, the CSV exports, batch give/return,
+# student imports and jobs, add_new_student, /metrics and backfill_stats are served by routes.py alone.
+app = Quart(__name__)
+
+json_response = json_responder(Response)
+
+
+def conditional(*tables: str, varies: Callable[[], Tuple] = tuple):
+    """routes.conditional for coroutine views"""
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        async def wrapper(*args: Any, **kwargs: Any) -> Response:
+            validators = Validators(tables, varies())
+            if validators.client_is_current(request.headers):
+                return validators.tag(Response('', status=304))
+            return validators.tag(await make_response(await view(*args, **kwargs)))
+
+        return wrapper
+
+    return decorator
+
+
+async def most_popular_book_as_dict() -> Optional[Dict[str, Any]]:
+    most_popular = await aio.most_popular_book()
+    if not most_popular:
+        return None
+
+    book_data, rec_count = most_popular
+    most_popular_book = book_data.to_json()
+    most_popular_book['rec_count'] = rec_count
+    return most_popular_book
+
+
+async def most_reading_students_as_dicts(year: int) -> List[Dict[str, Any]]:
+    return [dict(student) for student in await aio.most_reading_students(year)]
+
+
+@app.route('/library/get_all', methods=['GET'])
+@conditional('books')
+async def get_all_books():
+    limit, after = page_args(request.args)
+    if catalogue.enabled:
+        books = catalogue.all_books(limit=limit, after=after)
+    else:
+        books = await aio.all_books(limit=limit, after=after)
+
+    # A full last page still gives a cursor, the page after it is empty rather than missing
+    if books or after is not None:
+        return json_response(
+            book_list=books,
+            next_after=books[-1]['book_id'] if len(books) == limit else None
+        ), 200
+    else:
+        return 'There are no books in the library', 404
+
+
+@app.route('/library/get_by_name', methods=['GET'])
+@conditional('books', 'authors')
+async def get_books_by_title():
+    title = request.args.get('title', type=str)
+    limit = request.args.get('limit', default=SEARCH_LIMIT, type=int)
+    if catalogue.enabled:
+        books = catalogue.book_by_name(title=title, limit=limit)
+    else:
+        books = await aio.book_by_name(title=title, limit=limit)
+
+    if books:
+        return json_response(book_list=books), 200
+    else:
+        return f'There is no book with title {title} in the library', 404
+
+
+@app.route('/library/book_recommendations', methods=['GET'])
+async def get_book_recommendations():
+    student_id = request.args.get('student_id', type=int)
+    recommendations_data = await aio.recommendations_for_student(student_id)
+
+    if isinstance(recommendations_data, list):
+        return jsonify(recommendations=[book.to_json() for book in recommendations_data]), 200
+    else:
+        return recommendations_data
+
+
+@app.route('/library/sum_of_books_by_author', methods=['GET'])
+@conditional('books')
+async def get_sum_of_books_by_author():
+    author_id = request.args.get('author_id', type=int)
+    if catalogue.enabled:
+        sum_of_books = catalogue.sum_of_books_by_author_id(author_id=author_id)
+    else:
+        sum_of_books = await aio.sum_of_books_by_author_id(author_id=author_id)
+
+    if sum_of_books:
+        return f'The author with id {author_id} has {sum_of_books} books remaining in the library', 200
+    else:
+        return 'There are no books by this author in the library', 404
+
+
+@app.route('/library/avg_count_of_receiving_books', methods=['GET'])
+@conditional('receiving_books', 'receiving_stats_daily', varies=lambda: (date.today(),))
+async def get_avg_count():
+    cur_date = datetime.now()
+    cur_date_str = cur_date.strftime("%d-%m-%Y")
+    month = request.args.get('month', default=cur_date.month, type=int)
+    year = request.args.get('year', default=cur_date.year, type=int)
+
+    if not 1 <= month <= 12 or not MINYEAR <= year < MAXYEAR:
+        return 'month must be between 1 and 12 and year a valid calendar year', 400
+
+    avg_count = await analytics_cache.get_or_set_async(
+        ('avg_count_of_receiving_books', year, month),
+        ('receiving_books', 'receiving_stats_daily'),
+        lambda: aio.avg_count_of_receiving_books(month, year)
+    )
+
+    if avg_count:
+        return (
+            'Average count of books students borrowed in {month:02d}-{year} = {avg_count}'
+            '\nRequest date: {rec_date}'
+        ).format(
+            month=month,
+            year=year,
+            avg_count=round(avg_count, 2),
+            rec_date=cur_date_str
+        ), 200
+    else:
+        return (
+            'Students did not take books in {month:02d}-{year}'
+            '\nRequest date: {rec_date}'
+        ).format(
+            month=month,
+            year=year,
+            rec_date=cur_date_str
+        ), 404
+
+
+@app.route('/library/most_popular_book', methods=['GET'])
+@conditional('books', 'students', 'receiving_books', 'receiving_stats_daily')
+async def get_most_popular_book():
+    most_popular_book = await analytics_cache.get_or_set_async(
+        'most_popular_book',
+        ('books', 'students', 'receiving_books', 'receiving_stats_daily'),
+        most_popular_book_as_dict
+    )
+
+    if most_popular_book:
+        return jsonify(most_popular_book=most_popular_book), 200
+    else:
+        return 'There are no books in the library yet', 404
+
+
+@app.route('/library/most_reading_students', methods=['GET'])
+@conditional('students', 'receiving_books', 'receiving_stats_daily', varies=lambda: (date.today().year,))
+async def get_most_reading_students():
+    year = request.args.get('year', default=datetime.now().year, type=int)
+
+    if not MINYEAR <= year < MAXYEAR:
+        return 'year must be a valid calendar year', 400
+
+    students = await analytics_cache.get_or_set_async(
+        ('most_reading_students', year),
+        ('students', 'receiving_books', 'receiving_stats_daily'),
+        lambda: most_reading_students_as_dicts(year)
+    )
+
+    if students:
+        return json_response(most_reading_students=students), 200
+    else:
+        return 'There are no students data in the database yet', 404
+
+
+@app.route('/library/cache_stats', methods=['GET'])
+async def get_cache_stats():
+    return jsonify(analytics_cache=analytics_cache.stats(), catalogue=catalogue.stats()), 200
+
+
+@app.route('/library/catalogue_check', methods=['GET', 'POST'])
+async def check_catalogue():
+    if not catalogue.enabled:
+        return 'The catalogue snapshot is disabled', 404
+    # verify reads the books table through the sync engine, off the event loop
+    report = await asyncio.to_thread(catalogue.verify, repair=request.method == 'POST')
+    return jsonify(report), 200
+
+
+@app.route('/library/give_book', methods=['POST'])
+async def give_book():
+    form = await request.form
+    book_id = form.get('book_id', type=int)
+    student_id = form.get('student_id', type=int)
+
+    return await aio.add_receipt(book=book_id, student=student_id)
+
+
+@app.route('/library/return_book', methods=['POST'])
+async def return_book():
+    form = await request.form
+    book_id = form.get('book_id', type=int)
+    student_id = form.get('student_id', type=int)
+
+    return await aio.return_book(book=book_id, student=student_id)
+
+
+@app.before_serving
+async def prepare_database() -> None:
+    init_database()
+    if catalogue.enabled:
+        catalogue.load()
+
+
+@app.after_serving
+async def dispose_engines() -> None:
+    await aio.async_engine.dispose()
+    if aio.async_read_engine is not aio.async_engine:
+        await aio.async_read_engine.dispose()
@@ -0,0 +1,612 @@
+import argparse
+import asyncio
+import io
+import json
+import random
+import threading
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from statistics import mean, quantiles
+from time import perf_counter, sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask.testing import FlaskClient
+from sqlalchemy import event, func, insert, literal_column, select, update
+from sqlalchemy.sql.elements import ClauseElement
+
+from module_21_orm_2.homework.app.models.author import Author
+from module_21_orm_2.homework.app.models.book import (
+    Book, books_fts, author_available_query, books_page_query, search_books_query
+)
+from module_21_orm_2.homework.app.models.cache import analytics_cache
+from module_21_orm_2.homework.app.models.catalogue import catalogue
+from module_21_orm_2.homework.app.models.init import engine, read_engine, session, PAGE_LIMIT
+from module_21_orm_2.homework.app.models.migrations import init_database
+from module_21_orm_2.homework.app.models.prepare_data import generate_data
+from module_21_orm_2.homework.app.models.receiving_books import (
+    ReceivingBooks, books, checkin_query, checkout_query, close_loan_query, new_receipt_query
+)
+from module_21_orm_2.homework.app.models.student import Student, student_query
+from module_21_orm_2.homework.app.routes import app
+from module_21_orm_2.homework.app.serializers import dumps
+
+# Reports land under the working directory, benchmarks/ is ignored by git
+RESULTS_FOLDER = Path('benchmarks/')
+
+Case = Tuple[str, Callable[[FlaskClient, random.Random], Any]]
+
+# Most SQL statements a single request of each case may run with a cold cache,
+# a relationship loaded by accident shows up here before it shows up in latency
+QUERY_BUDGETS = {
+    'get_all': 1,
+    'get_all_stream': 1,
+    'get_by_name': 1,
+    'debtors': 1,
+    'book_recommendations': 2,
+    'book_recommendations_batch': 1,
+    'avg_count_of_receiving_books': 1,
+    'most_popular_book': 1,
+    'most_reading_students': 1,
+    'sum_of_books_by_author': 1,
+    'cache_stats': 0,
+    'metrics': 0,
+    'give_and_return_book': 5,
+    'give_and_return_books': 8,
+    'add_new_student': 1,
+    'add_students_from_file': 0,
+}
+
+# Paged statements with the indexes their SQLite plan must read rows through, in page order.
+# A filtered walk of the primary key or a TEMP B-TREE sort makes a page cost in proportion to the table
+DEBTORS_INDEXES = (
+    'ix_receiving_books_open_receipt_id', 'ix_receiving_books_late_returns', 'ix_receiving_books_archive_late_returns'
+)
+PLAN_CHECKS: Dict[str, Tuple[Callable[[], Tuple[ClauseElement, Dict[str, Any]]], Tuple[str, ...]]] = {
+    'get_all_after': (
+        lambda: (books_page_query(True, keyset=True), {'limit': PAGE_LIMIT, 'after': 0}),
+        ('INTEGER PRIMARY KEY',)
+    ),
+    'debtors': (lambda: (ReceivingBooks.debtor_loans().limit(PAGE_LIMIT), {}), DEBTORS_INDEXES),
+    'debtors_after': (lambda: (ReceivingBooks.debtor_loans(after=0).limit(PAGE_LIMIT), {}), DEBTORS_INDEXES),
+}
+
+_statements = threading.local()
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    _statements.count = getattr(_statements, 'count', 0) + 1
+
+
+for _engine in {engine, read_engine}:
+    event.listen(_engine, 'before_cursor_execute', count_statement)
+
+
+class Sample:
+    """Ids and words the request cases draw their parameters from"""
+
+    def __init__(self, size: int = 1000):
+        self.book_ids = session.scalars(select(Book.book_id).order_by(func.random()).limit(size)).all()
+        self.student_ids = session.scalars(select(Student.student_id).order_by(func.random()).limit(size)).all()
+        self.author_ids = session.scalars(select(Author.author_id).order_by(func.random()).limit(size)).all()
+        self.title_words = [
+            name.split()[-1]
+            for name in session.scalars(select(Book.name).order_by(func.random()).limit(size))
+        ]
+        self.new_students = 0
+        session.remove()
+
+    def student_csv(self, rows: int = 100) -> bytes:
+        lines = ['name;surname;phone;email;average_score;scholarship']
+        for _ in range(rows):
+            self.new_students += 1
+            key = f'{datetime.now():%H%M%S%f}{self.new_students}'
+            lines.append(f'Bench{key};Student;+79{self.new_students % 10 ** 9:09d};bench{key}@example.ru;4.5;True')
+        return '\n'.join(lines).encode()
+
+
+def route_cases(sample: Sample) -> List[Case]:
+    """One case per route in routes.py. Checkouts are returned straight away, so repeated runs see the same data."""
+
+    def give_and_return(client: FlaskClient, rnd: random.Random):
+        form = {'book_id': rnd.choice(sample.book_ids), 'student_id': rnd.choice(sample.student_ids)}
+        client.post('/library/give_book', data=form)
+        return client.post('/library/return_book', data=form)
+
+    def give_and_return_books(client: FlaskClient, rnd: random.Random):
+        pairs = [
+            {'book_id': rnd.choice(sample.book_ids), 'student_id': rnd.choice(sample.student_ids)}
+            for _ in range(100)
+        ]
+        client.post('/library/give_books', json=pairs)
+        return client.post('/library/return_books', json=pairs)
+
+    def add_new_student(client: FlaskClient, rnd: random.Random):
+        sample.new_students += 1
+        key = f'{datetime.now():%H%M%S%f}{sample.new_students}'
+        return client.post('/library/add_new_student', json={
+            'name': f'Bench{key}', 'surname': 'Student', 'phone': '+79000000000',
+            'email': f'bench{key}@example.ru', 'average_score': 4.5, 'scholarship': True
+        })
+
+    def import_students(client: FlaskClient, rnd: random.Random):
+        # The upload only queues a job, the case lasts until the import worker has finished it
+        response = client.post(
+            '/library/add_students_from_file',
+            data={'files': (io.BytesIO(sample.student_csv()), 'students.csv')}
+        )
+        status_url = response.get_json()['status_url']
+        while response.get_json()['status'] in ('queued', 'running'):
+            sleep(0.001)
+            response = client.get(status_url)
+        return response
+
+    return [
+        ('get_all', lambda client, rnd: client.get(
+            '/library/get_all', query_string={'after': rnd.choice(sample.book_ids)})),
+        ('get_all_stream', lambda client, rnd: client.get('/library/get_all', query_string={'stream': 1})),
+        ('get_by_name', lambda client, rnd: client.get(
+            '/library/get_by_name', query_string={'title': rnd.choice(sample.title_words)})),
+        ('debtors', lambda client, rnd: client.get('/library/debtors')),
+        ('book_recommendations', lambda client, rnd: client.get(
+            '/library/book_recommendations', query_string={'student_id': rnd.choice(sample.student_ids)})),
+        ('book_recommendations_batch', lambda client, rnd: client.post(
+            '/library/book_recommendations',
+            json={'student_ids': rnd.sample(sample.student_ids, min(50, len(sample.student_ids)))})),
+        ('avg_count_of_receiving_books', lambda client, rnd: client.get('/library/avg_count_of_receiving_books')),
+        ('most_popular_book', lambda client, rnd: client.get('/library/most_popular_book')),
+        ('most_reading_students', lambda client, rnd: client.get('/library/most_reading_students')),
+        ('sum_of_books_by_author', lambda client, rnd: client.get(
+            '/library/sum_of_books_by_author', query_string={'author_id': rnd.choice(sample.author_ids)})),
+        ('cache_stats', lambda client, rnd: client.get('/library/cache_stats')),
+        ('metrics', lambda client, rnd: client.get('/metrics')),
+        ('give_and_return_book', give_and_return),
+        ('give_and_return_books', give_and_return_books),
+        ('add_new_student', add_new_student),
+        ('add_students_from_file', import_students),
+    ]
+
+
+def run_case(client: FlaskClient, case: Case, requests: int, rnd: random.Random, cold: bool) -> Dict[str, Any]:
+    name, send = case
+    latencies = list()
+    statements = list()
+
+    for _ in range(requests):
+        if cold:
+            analytics_cache.clear()
+        _statements.count = 0
+
+        started = perf_counter()
+        response = send(client, rnd)
+        response.get_data()
+        response.close()
+        latencies.append((perf_counter() - started) * 1000)
+        statements.append(_statements.count)
+
+    p50, p95, p99 = percentiles(latencies)
+    return {
+        'route': name,
+        'requests': requests,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'mean_ms': mean(latencies),
+        'queries_per_request': mean(statements),
+        'max_queries': max(statements),
+        'query_budget': QUERY_BUDGETS.get(name)
+    }
+
+
+def over_budget(report: Dict[str, Any]) -> List[str]:
+    return [
+        row['route']
+        for row in report['results']
+        if row['query_budget'] is not None and row['max_queries'] > row['query_budget']
+    ]
+
+
+def query_plans() -> Dict[str, List[str]]:
+    """EXPLAIN QUERY PLAN details of every PLAN_CHECKS statement"""
+    plans = dict()
+    with engine.connect() as connection:
+        for name, (build, _) in PLAN_CHECKS.items():
+            query, params = build()
+            compiled = query.compile(connection)
+            parameters = compiled.construct_params(params)
+            plans[name] = [
+                row.detail
+                for row in connection.exec_driver_sql(
+                    f'EXPLAIN QUERY PLAN {compiled.string}',
+                    tuple(parameters[key] for key in compiled.positiontup)
+                )
+            ]
+    return plans
+
+
+def plan_problems(name: str, plan: List[str]) -> List[str]:
+    _, indexes = PLAN_CHECKS[name]
+    problems = [f'does not use {index}' for index in indexes if not any(index in step for step in plan)]
+    problems.extend(step for step in plan if step.startswith('USE TEMP B-TREE'))
+    return problems
+
+
+def serialization_benchmark(rows: int, repeat: int = 5) -> Dict[str, float]:
+    """Rows per second for a get_all page built from ORM objects + to_json versus Core mappings + serializers.dumps"""
+
+    def orm_path() -> bytes:
+        books = Book.all_books(limit=rows)
+        return app.json.dumps({'book_list': [book.to_json() for book in books]}).encode()
+
+    def raw_path() -> bytes:
+        return dumps({'book_list': Book.all_books(limit=rows, raw=True)})
+
+    result = dict()
+    with app.app_context():
+        for name, build in (('orm_rows_per_second', orm_path), ('raw_rows_per_second', raw_path)):
+            best = float('inf')
+            for _ in range(repeat):
+                started = perf_counter()
+                build()
+                best = min(best, perf_counter() - started)
+                session.remove()
+            result[name] = rows / best
+
+    result['speedup'] = result['raw_rows_per_second'] / result['orm_rows_per_second']
+    return result
+
+
+def statement_cases() -> Dict[str, Tuple[Callable[[], List[ClauseElement]], List[ClauseElement]]]:
+    """Per hot classmethod: a builder of the statements as they were written inline, and the prebuilt ones"""
+    return {
+        'all_books': (
+            lambda: [select(Book).order_by(Book.book_id).limit(100).where(Book.book_id > 10)],
+            [books_page_query(False, True)]
+        ),
+        'book_by_name': (
+            lambda: [select(Book).join(books_fts, books_fts.c.rowid == Book.book_id).where(
+                literal_column('books_fts').op('MATCH')('"book"*')).order_by(books_fts.c.rank).limit(100)],
+            [search_books_query(False)]
+        ),
+        'sum_of_books_by_author_id': (
+            lambda: [select(func.sum(Book.available)).where(Book.author_id == 1)],
+            [author_available_query]
+        ),
+        'student_by_id': (
+            lambda: [select(Student).where(Student.student_id == 1)],
+            [student_query(False)]
+        ),
+        'add_receipt': (
+            lambda: [
+                select(ReceivingBooks.receipt_id).where(
+                    ReceivingBooks.book_id == 1, ReceivingBooks.student_id == 1,
+                    ReceivingBooks.date_of_return == None).limit(1),
+                update(books).where(books.c.book_id == 1, books.c.available > 0).values(
+                    available=books.c.available - 1),
+                insert(ReceivingBooks).values(book_id=1, student_id=1),
+            ],
+            [new_receipt_query, checkout_query]
+        ),
+        'return_book': (
+            lambda: [
+                update(ReceivingBooks).where(
+                    ReceivingBooks.book_id == 1, ReceivingBooks.student_id == 1,
+                    ReceivingBooks.date_of_return == None).values(date_of_return=datetime.now()),
+                update(books).where(books.c.book_id == 1).values(available=books.c.available + 1),
+            ],
+            [close_loan_query, checkin_query]
+        ),
+    }
+
+
+def statement_benchmark(calls: int) -> Dict[str, Dict[str, float]]:
+    """Microseconds of Python work per call before any SQL runs: building the statements and the cache key
+    SQLAlchemy looks the compiled SQL up by. Prebuilt statements keep their key memoized."""
+    result = dict()
+    for name, (build_inline, prebuilt) in statement_cases().items():
+        started = perf_counter()
+        for _ in range(calls):
+            for statement in build_inline():
+                statement._generate_cache_key()
+        inline = (perf_counter() - started) / calls * 1e6
+
+        started = perf_counter()
+        for _ in range(calls):
+            for statement in prebuilt:
+                statement._generate_cache_key()
+        reused = (perf_counter() - started) / calls * 1e6
+
+        result[name] = {'inline_us': inline, 'prebuilt_us': reused, 'speedup': inline / reused}
+    return result
+
+
+def stress_checkout(threads: int, operations: int, pool: int = 20, seed: int = 0) -> Dict[str, Any]:
+    """Threads give and return random pairs out of `pool` books and `pool` students, so they keep colliding
+    on the same loans and copies. Afterwards no pair may hold two open loans, and available + open loans
+    of every book must be what it was before: a checkout or return moves one copy from one to the other."""
+    book_ids = session.scalars(select(Book.book_id).order_by(Book.book_id).limit(pool)).all()
+    student_ids = session.scalars(select(Student.student_id).order_by(Student.student_id).limit(pool)).all()
+    open_loans = ReceivingBooks.date_of_return == None
+    on_loan = select(func.count()).where(ReceivingBooks.book_id == Book.book_id, open_loans).scalar_subquery()
+    copies_query = select(Book.book_id, Book.available + on_loan).where(Book.book_id.in_(book_ids))
+    copies_before = {book_id: copies for book_id, copies in session.execute(copies_query)}
+    session.remove()
+    if catalogue.enabled:
+        catalogue.load()
+
+    statuses = Counter()
+    lock = threading.Lock()
+    start = threading.Barrier(threads + 1)
+
+    def worker(number: int) -> None:
+        rnd = random.Random(seed + number)
+        client = app.test_client()
+        seen = Counter()
+        start.wait()
+        for _ in range(operations):
+            action = rnd.choice(('give_book', 'return_book'))
+            form = {'book_id': rnd.choice(book_ids), 'student_id': rnd.choice(student_ids)}
+            seen[f'{action} {client.post(f"/library/{action}", data=form).status_code}'] += 1
+        with lock:
+            statuses.update(seen)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    start.wait()
+    started = perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = perf_counter() - started
+
+    duplicates = session.scalar(select(func.count()).select_from(
+        select(ReceivingBooks.book_id).where(open_loans).group_by(
+            ReceivingBooks.book_id, ReceivingBooks.student_id
+        ).having(func.count() > 1).subquery()
+    ))
+    copies_after = {book_id: copies for book_id, copies in session.execute(copies_query)}
+    lost_updates = sum(copies_after[book] != copies for book, copies in copies_before.items())
+    session.remove()
+    # The snapshot followed every commit above through its engine hooks, it has to match the table now
+    snapshot_mismatches = len(catalogue.verify()['mismatched']) if catalogue.enabled else None
+
+    return {
+        'threads': threads,
+        'operations': threads * operations,
+        'seconds': elapsed,
+        'operations_per_second': threads * operations / elapsed,
+        'statuses': dict(sorted(statuses.items())),
+        'duplicate_open_loans': duplicates,
+        'books_with_lost_updates': lost_updates,
+        'catalogue_snapshot_mismatches': snapshot_mismatches
+    }
+
+
+def polling_requests(sample: Sample) -> Callable[[random.Random], Tuple[str, Dict[str, Any]]]:
+    """Kiosk and dashboard traffic: (path, query string) pairs for title search, author stock and analytics"""
+
+    def draw(rnd: random.Random) -> Tuple[str, Dict[str, Any]]:
+        return rnd.choice((
+            ('/library/get_by_name', {'title': rnd.choice(sample.title_words)}),
+            ('/library/sum_of_books_by_author', {'author_id': rnd.choice(sample.author_ids)}),
+            ('/library/most_reading_students', {}),
+        ))
+
+    return draw
+
+
+def concurrency_comparison(clients: int, requests: int, seed: int = 0) -> Dict[str, Dict[str, Any]]:
+    """The same polling mix from `clients` concurrent clients against the sync app, a thread per client,
+    and the async app, a coroutine per client on one event loop. Threads and traced Python memory
+    are sampled at the end of each run, while every client is still alive."""
+    from module_21_orm_2.homework.app.async_routes import app as async_app
+
+    draw = polling_requests(Sample())
+    result = dict()
+
+    def summary(latencies: List[float], elapsed: float, threads: int) -> Dict[str, Any]:
+        p50, p95, p99 = percentiles(latencies)
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'requests': len(latencies),
+            'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'threads': threads,
+            'peak_traced_mb': peak / 2 ** 20
+        }
+
+    def sync_client(number: int) -> List[float]:
+        rnd = random.Random(seed + number)
+        client = app.test_client()
+        latencies = list()
+        start.wait()
+        for _ in range(requests):
+            path, query = draw(rnd)
+            started = perf_counter()
+            client.get(path, query_string=query).close()
+            latencies.append((perf_counter() - started) * 1000)
+        finish.wait()
+        return latencies
+
+    start = threading.Barrier(clients + 1)
+    finish = threading.Barrier(clients + 1)
+    tracemalloc.start()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        futures = [pool.submit(sync_client, number) for number in range(clients)]
+        start.wait()
+        started = perf_counter()
+        finish.wait()
+        elapsed = perf_counter() - started
+        threads = threading.active_count()
+        result['sync'] = summary([ms for future in futures for ms in future.result()], elapsed, threads)
+    tracemalloc.stop()
+
+    async def async_client(client, number: int) -> List[float]:
+        rnd = random.Random(seed + number)
+        latencies = list()
+        for _ in range(requests):
+            path, query = draw(rnd)
+            started = perf_counter()
+            response = await client.get(path, query_string=query)
+            await response.get_data()
+            latencies.append((perf_counter() - started) * 1000)
+        return latencies
+
+    async def run_async() -> Dict[str, Any]:
+        async with async_app.test_app() as test_app:
+            client = test_app.test_client()
+            started = perf_counter()
+            runs = await asyncio.gather(*(async_client(client, number) for number in range(clients)))
+            elapsed = perf_counter() - started
+            return summary([ms for run in runs for ms in run], elapsed, threading.active_count())
+
+    tracemalloc.start()
+    result['async'] = asyncio.run(run_async())
+    tracemalloc.stop()
+
+    return result
+
+
+def percentiles(values: List[float]) -> Tuple[float, float, float]:
+    if len(values) < 2:
+        return values[0], values[0], values[0]
+    cuts = quantiles(values, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+def run(requests: int, seed: int, cold: bool, only: Optional[List[str]] = None) -> Dict[str, Any]:
+    rnd = random.Random(seed)
+    sample = Sample()
+    client = app.test_client()
+    # Loaded once up front as the server does at startup, the first catalogue read would count the load
+    if catalogue.enabled:
+        catalogue.load()
+
+    results = [
+        run_case(client, case, requests, rnd, cold)
+        for case in route_cases(sample)
+        if not only or case[0] in only
+    ]
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'database': str(engine.url),
+        'read_database': str(read_engine.url),
+        'requests_per_route': requests,
+        'cold_cache': cold,
+        'results': results
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    previous = {row['route']: row for row in baseline['results']} if baseline else dict()
+
+    print(f"{'route':<30}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}{'p95 vs base':>14}")
+    for row in report['results']:
+        delta = ''
+        if row['route'] in previous and previous[row['route']]['p95_ms']:
+            delta = f"{(row['p95_ms'] / previous[row['route']]['p95_ms'] - 1) * 100:+.1f}%"
+        print(
+            f"{row['route']:<30}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+            f"{row['queries_per_request']:>10.1f}{delta:>14}"
+        )
+
+
+def save_report(report: Dict[str, Any], folder: Path = RESULTS_FOLDER) -> Path:
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json"
+    path.write_text(json.dumps(report, indent=2))
+    return path
+
+
+def latest_report(folder: Path = RESULTS_FOLDER) -> Optional[Dict[str, Any]]:
+    reports = sorted(folder.glob('benchmark-*.json'))
+    return json.loads(reports[-1].read_text()) if reports else None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Drive every library route and report latency percentiles')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold', action='store_true', help='clear the analytics cache before every request')
+    parser.add_argument('--route', action='append', help='only run the given route case, can be repeated')
+    parser.add_argument('--serialization', type=int, metavar='ROWS',
+                        help='compare ORM and Core-row serialization of ROWS books and exit')
+    parser.add_argument('--statements', type=int, metavar='CALLS',
+                        help='compare inline and prebuilt statement overhead over CALLS calls and exit')
+    parser.add_argument('--stress', type=int, metavar='THREADS',
+                        help='give and return books from THREADS threads, --requests times each, check the loan '
+                             'invariants and exit')
+    parser.add_argument('--compare-async', type=int, metavar='CLIENTS',
+                        help='poll the sync and the async app from CLIENTS concurrent clients, --requests each, '
+                             'and exit (needs quart and aiosqlite)')
+    parser.add_argument('--check-queries', action='store_true',
+                        help='exit with an error when a route runs more statements than its QUERY_BUDGETS entry')
+    parser.add_argument('--check-plans', action='store_true',
+                        help='print the plans of the PLAN_CHECKS statements, exit with an error when one misses '
+                             'its indexes or sorts, and exit')
+    parser.add_argument('--baseline', type=Path, help='report to compare with, defaults to the latest saved one')
+    parser.add_argument('--generate', nargs=4, type=int, metavar=('AUTHORS', 'BOOKS', 'STUDENTS', 'RECEIPTS'),
+                        help='append a synthetic dataset of this size before running')
+    args = parser.parse_args()
+
+    init_database()
+
+    if args.generate:
+        print(generate_data(*args.generate, seed=args.seed))
+
+    if args.serialization:
+        for name, value in serialization_benchmark(args.serialization).items():
+            print(f'{name:<22}{value:>14.1f}')
+        return
+
+    if args.stress:
+        result = stress_checkout(args.stress, args.requests, seed=args.seed)
+        print(json.dumps(result, indent=2))
+        if result['duplicate_open_loans'] or result['books_with_lost_updates']:
+            raise SystemExit('Loan invariants are broken')
+        return
+
+    if args.compare_async:
+        comparison = concurrency_comparison(args.compare_async, args.requests, seed=args.seed)
+        print(f"{'app':<8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'threads':>10}{'peak MB':>10}")
+        for name, row in comparison.items():
+            print(
+                f"{name:<8}{row['requests_per_second']:>10.1f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+                f"{row['threads']:>10}{row['peak_traced_mb']:>10.1f}"
+            )
+        return
+
+    if args.check_plans:
+        failed = list()
+        for name, plan in query_plans().items():
+            print(name)
+            for step in plan:
+                print(f'    {step}')
+            for problem in plan_problems(name, plan):
+                print(f'  ! {problem}')
+                failed.append(name)
+        if failed:
+            raise SystemExit(f'Off-index plans: {", ".join(sorted(set(failed)))}')
+        return
+
+    if args.statements:
+        print(f"{'statement':<28}{'inline us':>12}{'prebuilt us':>14}{'speedup':>10}")
+        for name, row in statement_benchmark(args.statements).items():
+            print(f"{name:<28}{row['inline_us']:>12.2f}{row['prebuilt_us']:>14.2f}{row['speedup']:>10.1f}")
+        return
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else latest_report()
+    report = run(args.requests, args.seed, args.cold, args.route)
+
+    print_report(report, baseline)
+    print(f'Saved to {save_report(report)}')
+
+    if args.check_queries and over_budget(report):
+        raise SystemExit(f'Over the query budget: {", ".join(over_budget(report))}')
+
+
+if __name__ == '__main__':
+    main()
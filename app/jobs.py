@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import monotonic
+from typing import Any, Callable, Dict, Optional
+
+from module_21_orm_2.homework.app.models.init import session
+
+IMPORT_WORKERS = int(os.environ.get('LIBRARY_IMPORT_WORKERS', 1))
+MAX_PENDING_IMPORTS = int(os.environ.get('LIBRARY_MAX_PENDING_IMPORTS', 8))
+JOB_HISTORY_SIZE = int(os.environ.get('LIBRARY_JOB_HISTORY_SIZE', 100))
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    __slots__ = (
+        'job_id', 'kind', 'status', 'created_at', 'started', 'finished',
+        'processed', 'rejected', 'result', 'error'
+    )
+
+    def __init__(self, kind: str):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.created_at = datetime.now()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.processed = 0
+        self.rejected = 0
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+
+    def progress(self, report: Dict[str, int]) -> None:
+        """Callback for the import loop, gets the running report of row counts after every batch"""
+        self.processed = sum(report.values())
+        self.rejected = report['rejected']
+
+    def to_json(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started is not None:
+            elapsed = (self.finished or monotonic()) - self.started
+
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(timespec='seconds'),
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'seconds': round(elapsed, 3) if elapsed is not None else None,
+            'rows_per_second': round(self.processed / elapsed, 1) if elapsed else None,
+            'result': self.result,
+            'error': self.error
+        }
+
+
+class JobQueue:
+    """Runs jobs on a bounded thread pool: at most `workers` at once, so imports leave database
+    time for the request threads, and at most `max_pending` queued or running before new ones are refused"""
+
+    def __init__(self, workers: int, max_pending: int, history_size: int = JOB_HISTORY_SIZE):
+        self.max_pending = max_pending
+        self.history_size = history_size
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='library-job')
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, work: Callable[[Job], Dict[str, Any]]) -> Job:
+        """Queues work(job), its return value becomes the job result. Raises QueueFull when the queue is at its limit."""
+        job = Job(kind)
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f'{self._pending} jobs are already queued or running, try again later')
+            self._pending += 1
+            self._jobs[job.job_id] = job
+            self._trim_history()
+
+        self._executor.submit(self._run, job, work)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, work: Callable[[Job], Dict[str, Any]]) -> None:
+        job.status = 'running'
+        job.started = monotonic()
+        try:
+            job.result = work(job)
+            job.status = 'done'
+        except Exception as exc:
+            logger.exception('Job %s (%s) failed', job.job_id, job.kind)
+            job.error = f'{exc}'
+            job.status = 'failed'
+        finally:
+            job.finished = monotonic()
+            # Worker threads outlive the job, the next one must not inherit this session
+            session.remove()
+            with self._lock:
+                self._pending -= 1
+
+    def _trim_history(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self._jobs) - self.history_size)]:
+            del self._jobs[job_id]
+
+
+import_jobs = JobQueue(workers=IMPORT_WORKERS, max_pending=MAX_PENDING_IMPORTS)
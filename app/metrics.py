@@ -0,0 +1,112 @@
+import os
+import threading
+from collections import Counter, defaultdict
+from time import perf_counter
+from typing import Dict, Iterable, List
+
+from flask import Flask, Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('LIBRARY_N_PLUS_ONE_THRESHOLD', 3))
+
+
+class RouteStats:
+    __slots__ = ('requests', 'seconds', 'statements', 'sql_seconds', 'n_plus_one_requests')
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.n_plus_one_requests = 0
+
+
+class QueryMetrics:
+    """Per-route request and SQL statistics collected from cursor-execute events and Flask request hooks.
+    A request running the same statement N_PLUS_ONE_THRESHOLD times or more is counted as an N+1 suspect."""
+
+    def __init__(self, engines: Iterable[Engine], n_plus_one_threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self._routes: Dict[str, RouteStats] = defaultdict(RouteStats)
+        self._lock = threading.Lock()
+
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def init_app(self, app: Flask) -> None:
+        self.app = app
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    @staticmethod
+    def _start_request() -> None:
+        g.request_started = perf_counter()
+        g.sql_metrics = {'statements': Counter(), 'seconds': 0.0}
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        # Kept on the execution context, a statement that raises takes its start time with it
+        context.query_started = perf_counter()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = perf_counter() - context.query_started
+
+        if has_request_context() and 'sql_metrics' in g:
+            g.sql_metrics['statements'][statement] += 1
+            g.sql_metrics['seconds'] += elapsed
+
+    def _finish_request(self, response: Response) -> Response:
+        if 'request_started' in g:
+            # Streamed bodies run their queries after this hook, so the request is recorded once the body is closed
+            route = request.endpoint or 'unmatched'
+            started, sql_metrics = g.request_started, g.sql_metrics
+            response.call_on_close(lambda: self._record(route, started, sql_metrics))
+        return response
+
+    def _record(self, route: str, started: float, sql_metrics: Dict) -> None:
+        statements: Counter = sql_metrics['statements']
+        repeated = {statement: count for statement, count in statements.items() if count >= self.n_plus_one_threshold}
+
+        if repeated:
+            statement, count = max(repeated.items(), key=lambda item: item[1])
+            self.app.logger.warning('Possible N+1 in %s: statement ran %d times: %s', route, count, statement)
+
+        with self._lock:
+            stats = self._routes[route]
+            stats.requests += 1
+            stats.seconds += perf_counter() - started
+            stats.statements += sum(statements.values())
+            stats.sql_seconds += sql_metrics['seconds']
+            stats.n_plus_one_requests += bool(repeated)
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            samples = {
+                'library_requests_total': [(route, stats.requests) for route, stats in routes],
+                'library_request_seconds_total': [(route, stats.seconds) for route, stats in routes],
+                'library_sql_statements_total': [(route, stats.statements) for route, stats in routes],
+                'library_sql_seconds_total': [(route, stats.sql_seconds) for route, stats in routes],
+                'library_n_plus_one_requests_total': [(route, stats.n_plus_one_requests) for route, stats in routes],
+            }
+
+        lines: List[str] = list()
+        for name, values in samples.items():
+            lines.append(f'# HELP {name} {METRIC_HELP[name]}')
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{name}{{route="{route}"}} {value}' for route, value in values)
+
+        return '\n'.join(lines) + '\n'
+
+
+METRIC_HELP = {
+    'library_requests_total': 'Handled requests.',
+    'library_request_seconds_total': 'Wall time spent handling requests.',
+    'library_sql_statements_total': 'SQL statements sent to the database.',
+    'library_sql_seconds_total': 'Time spent executing SQL statements.',
+    'library_n_plus_one_requests_total': 'Requests that ran one statement at least N_PLUS_ONE_THRESHOLD times.',
+}
@@ -0,0 +1,149 @@
+import os
+from datetime import date, datetime
+from typing import List, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import URL, event, make_url
+from sqlalchemy.engine import RowMapping
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from module_21_orm_2.homework.app.models.book import (
+    Book, author_available_query, books_page_query, most_popular_book_query, recommendations_query,
+    search_books_query, search_query_from, student_exists_query, SEARCH_LIMIT
+)
+from module_21_orm_2.homework.app.models.catalogue import watch_engine
+from module_21_orm_2.homework.app.models.changes import track_engine
+from module_21_orm_2.homework.app.models.init import (
+    engine, engine_options, read_engine, set_journal_mode, PAGE_LIMIT, POOL_SIZE, READ_POOL_SIZE
+)
+from module_21_orm_2.homework.app.models.receiving_books import (
+    checkin_query, checkout_query, close_loan_query, month_bounds, new_receipt_query
+)
+from module_21_orm_2.homework.app.models.receiving_stats import avg_issues_query, most_reading_students_query
+
+# Async counterparts of the hot model queries for the ASGI app in async_routes.py.
+# They run the prebuilt statements of the sync classmethods, so both apps send the same SQL.
+ASYNC_DATABASE_URL = os.environ.get('LIBRARY_ASYNC_DATABASE_URL')
+ASYNC_READ_DATABASE_URL = os.environ.get('LIBRARY_ASYNC_READ_DATABASE_URL')
+
+
+def async_url(url: Union[str, URL]) -> URL:
+    """sqlite:///library.db -> sqlite+aiosqlite:///library.db, URLs naming a driver are kept as they are"""
+    url = make_url(url)
+    if url.drivername == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite')
+    return url
+
+
+def make_async_engine(url: Union[str, URL], pool_size: int = POOL_SIZE) -> AsyncEngine:
+    return create_async_engine(url, **engine_options(url, pool_size))
+
+
+async_engine = make_async_engine(ASYNC_DATABASE_URL or async_url(engine.url))
+if ASYNC_READ_DATABASE_URL or read_engine is not engine:
+    async_read_engine = make_async_engine(ASYNC_READ_DATABASE_URL or async_url(read_engine.url), READ_POOL_SIZE)
+else:
+    async_read_engine = async_engine
+
+event.listen(async_engine.sync_engine, 'connect', set_journal_mode)
+# Commits of the async writer invalidate analytics_cache and update the catalogue snapshot like the sync ones do
+track_engine(async_engine.sync_engine)
+watch_engine(async_engine.sync_engine)
+
+# A session per call: nothing is shared between the tasks of concurrent requests
+WriteSession = async_sessionmaker(async_engine, expire_on_commit=False)
+ReadSession = async_sessionmaker(async_read_engine, expire_on_commit=False)
+
+
+async def all_books(limit: int = PAGE_LIMIT, after: Optional[int] = None) -> Sequence[RowMapping]:
+    async with ReadSession() as session:
+        result = await session.execute(
+            books_page_query(True, keyset=after is not None),
+            {'limit': limit, 'after': after}
+        )
+        return result.mappings().all()
+
+
+async def book_by_name(title: str, limit: int = SEARCH_LIMIT) -> Sequence[RowMapping]:
+    search_query = search_query_from(title)
+    if not search_query:
+        return []
+
+    async with ReadSession() as session:
+        result = await session.execute(search_books_query(True), {'search_query': search_query, 'limit': limit})
+        return result.mappings().all()
+
+
+async def recommendations_for_student(student_id: int) -> Union[List[Book], Tuple[str, int]]:
+    async with ReadSession() as session:
+        result = await session.execute(recommendations_query(), {'student_ids': [student_id]})
+        books = result.scalars(1).all()
+
+        if books:
+            return books
+
+        if not await session.scalar(student_exists_query, {'student_id': student_id}):
+            return 'There is no student with this ID', 400
+
+    return 'There are no recommendations for this student yet', 404
+
+
+async def sum_of_books_by_author_id(author_id: int) -> int:
+    async with ReadSession() as session:
+        return await session.scalar(author_available_query, {'author_id': author_id})
+
+
+async def avg_count_of_receiving_books(cur_month: int, cur_year: int) -> float:
+    start, end = month_bounds(cur_year, cur_month)
+    async with ReadSession() as session:
+        return await session.scalar(avg_issues_query, {'start': start, 'end': end})
+
+
+async def most_popular_book() -> Optional[Tuple[Book, int]]:
+    async with ReadSession() as session:
+        result = await session.execute(most_popular_book_query())
+        return result.first()
+
+
+async def most_reading_students(cur_year: int) -> Sequence[RowMapping]:
+    params = {'start': date(cur_year, 1, 1), 'end': date(cur_year + 1, 1, 1)}
+    async with ReadSession() as session:
+        result = await session.execute(most_reading_students_query(True), params)
+        return result.mappings().all()
+
+
+async def add_receipt(book: int, student: int) -> Tuple[str, int]:
+    """Same steps as ReceivingBooks.add_receipt"""
+    async with WriteSession() as session:
+        new_receipt = {'book_id': book, 'student_id': student, 'date_of_issue': datetime.now()}
+        if not (await session.execute(new_receipt_query, new_receipt)).rowcount:
+            await session.rollback()
+            return f'A student with id {student} has already taken a book with id {book}', 400
+
+        if not (await session.execute(checkout_query, {'checkout_book_id': book, 'taken': 1})).rowcount:
+            await session.rollback()
+            return f'There are no available copies of the book with id {book}', 400
+
+        await session.commit()
+
+    return f'Book with id {book} issued to student {student}', 201
+
+
+async def return_book(book: int, student: int) -> Tuple[str, int]:
+    """Same steps as ReceivingBooks.return_book"""
+    async with WriteSession() as session:
+        returned = (await session.execute(
+            close_loan_query,
+            {'return_book_id': book, 'return_student_id': student, 'returned_at': datetime.now()}
+        )).rowcount
+
+        if not returned:
+            await session.rollback()
+            return f'Student {student} did not take book {book}', 404
+        if returned > 1:
+            await session.rollback()
+            return f'Found more than one entry with input (book={book}, student={student})', 400
+
+        await session.execute(checkin_query, {'checkin_book_id': book, 'returned': 1})
+        await session.commit()
+
+    return f'Book with id {book} was returned', 200
@@ -1,6 +1,6 @@
 from typing import Any
 
-from sqlalchemy import Text
+from sqlalchemy import Text, inspect
 from sqlalchemy.orm import relationship, backref, Mapped, mapped_column
 
 from module_21_orm_2.homework.app.models.init import Base
@@ -13,7 +13,12 @@ class Author(Base):
     name: Mapped[str] = mapped_column(Text)
     surname: Mapped[str] = mapped_column(Text)
 
-    books = relationship('Book', backref=backref('author', cascade='all', lazy='joined'))
+    # Relationships are never loaded implicitly, queries ask for them with loader options
+    books = relationship(
+        'Book',
+        backref=backref('author', cascade='all', lazy='raise_on_sql'),
+        lazy='raise_on_sql'
+    )
 
     def __init__(self, name, surname, **kw: Any):
         super().__init__(**kw)
@@ -21,9 +26,11 @@ class Author(Base):
         self.surname = surname
 
     def __repr__(self):
+        # books is raise_on_sql, it is shown only when a loader option has already loaded it
+        books = '' if 'books' in inspect(self).unloaded else f"\n\tbooks = {self.books}"
         return ("Author("
                 f"\n\tauthor_id = {self.author_id}"
                 f"\n\tname = {self.name}"
                 f"\n\tsurname = {self.surname}"
-                f"\n\tbooks = {self.books}"
+                f"{books}"
                 "\n)")
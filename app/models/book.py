@@ -1,13 +1,60 @@
+import re
+from functools import lru_cache
 from datetime import date
-from typing import Optional, Tuple, Union, List, Dict, Any
+from typing import Optional, Tuple, Union, List, Dict, Any, Iterable, Sequence
 
-from sqlalchemy import Text, ForeignKey, Index, func, select, desc
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import (
+    Text, ForeignKey, Index, Select, Update,
+    bindparam, func, select, desc, update, exists, event, inspect, table, column, literal_column, or_, union
+)
+from sqlalchemy.engine import Connection, Result, RowMapping
+from sqlalchemy.orm import Mapped, mapped_column, relationship, aliased
 
-from module_21_orm_2.homework.app.models.init import Base, session
+from module_21_orm_2.homework.app.models.init import Base, session, fetch_all, PAGE_LIMIT, STREAM_BATCH_SIZE
+from module_21_orm_2.homework.app.models.loan_archive import ArchivedLoan
 from module_21_orm_2.homework.app.models.receiving_books import ReceivingBooks
+from module_21_orm_2.homework.app.models.receiving_stats import ReceivingStats
 from module_21_orm_2.homework.app.models.student import Student
 
+SEARCH_LIMIT = 100
+RECOMMENDATIONS_CHUNK_SIZE = 500
+SEARCH_TERM_PATTERN = re.compile(r'\w+')
+
+# FTS5 index over book titles and author names, its rowid is books.book_id.
+# Triggers keep it in sync with every write to books and authors, ORM or raw SQL alike.
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+    "title, author, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "INSERT INTO books_fts(books_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_after_insert AFTER INSERT ON books BEGIN "
+    "INSERT INTO books_fts(rowid, title, author) SELECT new.book_id, new.name, "
+    "(SELECT name || ' ' || surname FROM authors WHERE author_id = new.author_id); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_after_update AFTER UPDATE OF name, author_id ON books BEGIN "
+    "UPDATE books_fts SET title = new.name, "
+    "author = (SELECT name || ' ' || surname FROM authors WHERE author_id = new.author_id) "
+    "WHERE rowid = new.book_id; END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_after_delete AFTER DELETE ON books BEGIN "
+    "DELETE FROM books_fts WHERE rowid = old.book_id; END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_after_author_update AFTER UPDATE OF name, surname ON authors BEGIN "
+    "UPDATE books_fts SET author = new.name || ' ' || new.surname "
+    "WHERE rowid IN (SELECT book_id FROM books WHERE author_id = new.author_id); END",
+    # Books may be inserted before their author row, and an author may be deleted under its books
+    "CREATE TRIGGER IF NOT EXISTS books_fts_after_author_insert AFTER INSERT ON authors BEGIN "
+    "UPDATE books_fts SET author = new.name || ' ' || new.surname "
+    "WHERE rowid IN (SELECT book_id FROM books WHERE author_id = new.author_id); END",
+    "CREATE TRIGGER IF NOT EXISTS books_fts_after_author_delete AFTER DELETE ON authors BEGIN "
+    "UPDATE books_fts SET author = NULL "
+    "WHERE rowid IN (SELECT book_id FROM books WHERE author_id = old.author_id); END",
+)
+SEARCH_INDEX_REBUILD = (
+    "DELETE FROM books_fts",
+    "INSERT INTO books_fts(rowid, title, author) "
+    "SELECT books.book_id, books.name, authors.name || ' ' || authors.surname "
+    "FROM books LEFT JOIN authors ON authors.author_id = books.author_id",
+)
+
+books_fts = table('books_fts', column('rowid'), column('rank'))
+
 
 class Book(Base):
     __tablename__ = 'books'
@@ -15,23 +62,25 @@ class Book(Base):
     book_id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column('name', Text)
     count: Mapped[int] = mapped_column(default=1)
+    available: Mapped[int] = mapped_column(default=1)
     release_date: Mapped[date]
     author_id: Mapped[int] = mapped_column(ForeignKey('authors.author_id'))
 
-    students: Mapped['ReceivingBooks'] = relationship(
+    students: Mapped[List['ReceivingBooks']] = relationship(
         back_populates='book',
         cascade='all',
-        lazy='subquery'
+        lazy='raise_on_sql'
     )
 
     __table_args__ = (
-        Index('ix_books_author_id', 'author_id'),
+        Index('ix_books_author_id_available', 'author_id', 'available'),
     )
 
     def __init__(self, title, count, release_date, **kw: Any):
         super().__init__(**kw)
         self.name = title
         self.count = count
+        self.available = count
         self.release_date = release_date
 
     def __repr__(self):
@@ -39,63 +88,209 @@ class Book(Base):
                 f"\n\tbook_id = {self.book_id}"
                 f"\n\tname = {self.name}"
                 f"\n\tcount = {self.count}"
+                f"\n\tavailable = {self.available}"
                 f"\n\trelease_date = {self.release_date}"
                 f"\n\tauthor_id = {self.author_id}"
                 "\n)")
 
     @classmethod
-    def all_books(cls) -> Optional[List['Book']]:
-        return session.scalars(select(Book)).all()
+    def all_books(
+            cls,
+            limit: int = PAGE_LIMIT,
+            after: Optional[int] = None,
+            raw: bool = False
+    ) -> Union[List['Book'], Sequence[RowMapping]]:
+        query = books_page_query(raw, keyset=after is not None)
+        return fetch_all(query, raw, {'limit': limit, 'after': after})
+
+    @classmethod
+    def stream_books(cls, after: Optional[int] = None, batch_size: int = STREAM_BATCH_SIZE) -> Result:
+        query = select(Book.__table__).order_by(Book.book_id).execution_options(yield_per=batch_size)
+        if after is not None:
+            query = query.where(Book.book_id > after)
+        return session.execute(query).mappings()
+
+    @classmethod
+    def book_by_name(
+            cls,
+            title: str,
+            limit: int = SEARCH_LIMIT,
+            raw: bool = False
+    ) -> Union[List['Book'], Sequence[RowMapping]]:
+        search_query = search_query_from(title)
+        if not search_query:
+            return []
+
+        return fetch_all(search_books_query(raw), raw, {'search_query': search_query, 'limit': limit})
 
     @classmethod
-    def book_by_name(cls, title: str) -> List['Book']:
-        query = select(Book).where(Book.name.like(f'%{title}%'))
-        return session.scalars(query).all()
+    def rebuild_search_index(cls) -> None:
+        connection = session.connection()
+        for statement in SEARCH_INDEX_REBUILD:
+            connection.exec_driver_sql(statement)
+        session.commit()
 
     @classmethod
     def most_popular_book(cls) -> Tuple['Book', int]:
-        query = select(
-            Book,
-            func.count(ReceivingBooks.receipt_id).label('row_count')
-        ).join(
-            Student, ReceivingBooks.student
-        ).join(
-            Book, ReceivingBooks.book
-        ).group_by(
-            ReceivingBooks.book_id
-        ).having(
-            Student.average_score > 4
-        ).order_by(
-            desc('row_count'),
-            desc(Book.count)
-        )
-        # При выполнении запроса получаю следующее сообщение:
-        # SAWarning: Multiple rows returned with uselist=False for eagerly-loaded attribute 'Book.students'
-        #   return session.execute(query).first()
-        return session.execute(query).first()
+        return session.execute(most_popular_book_query()).first()
 
     @classmethod
     def recommendations_for_student(cls, student_id: int) -> Union[List['Book'], Tuple[str, int]]:
-        student: Optional['Student'] = Student.student_by_id(student_id)
+        books = session.execute(recommendations_query(), {'student_ids': [student_id]}).scalars(1).all()
+
+        if books:
+            return books
 
-        if not student:
+        if not session.scalar(student_exists_query, {'student_id': student_id}):
             return 'There is no student with this ID', 400
 
-        query = select(Book).where(
-            Book.author_id.in_(student.books_author),
-            Book.name.notin_(student.books_titles)
-        )
-        books = session.scalars(query).all()
+        return 'There are no recommendations for this student yet', 404
+
+    @classmethod
+    def recommendations_for_students(cls, student_ids: Iterable[int]) -> Dict[int, List['Book']]:
+        student_ids = list(dict.fromkeys(student_ids))
+        recommendations = {student_id: list() for student_id in student_ids}
 
-        if not books:
-            return 'There are no recommendations for this student yet', 404
+        for start in range(0, len(student_ids), RECOMMENDATIONS_CHUNK_SIZE):
+            chunk = student_ids[start:start + RECOMMENDATIONS_CHUNK_SIZE]
+            for student_id, book in session.execute(recommendations_query(), {'student_ids': chunk}):
+                recommendations[student_id].append(book)
 
-        return books
+        return recommendations
 
     @classmethod
     def sum_of_books_by_author_id(cls, author_id: int) -> int:
-        query = select(func.sum(Book.count)).where(Book.author_id == author_id)
-        return session.scalar(query)
+        return session.scalar(author_available_query, {'author_id': author_id})
+
+    @classmethod
+    def recount_available(cls) -> None:
+        session.execute(recount_available_query())
+        session.commit()
 
     def to_json(self) -> Dict[str, Any]:
         return {col.name: getattr(self, col.name) for col in self.__table__.columns}
+
+
+def recount_available_query() -> Update:
+    """Sets Book.available from the copy count and the loans that are still open"""
+    on_loan = select(
+        func.count(ReceivingBooks.receipt_id)
+    ).where(
+        ReceivingBooks.book_id == Book.book_id,
+        ReceivingBooks.date_of_return == None
+    ).scalar_subquery()
+
+    return update(Book.__table__).values(available=func.max(Book.count - on_loan, 0))
+
+
+@lru_cache(maxsize=None)
+def books_page_query(raw: bool, keyset: bool) -> Select:
+    """One keyset page of books, built once per variant: calls only bind limit and after"""
+    query = select(Book.__table__ if raw else Book).order_by(Book.book_id).limit(bindparam('limit'))
+    if keyset:
+        query = query.where(Book.book_id > bindparam('after'))
+    return query
+
+
+@lru_cache(maxsize=None)
+def search_books_query(raw: bool) -> Select:
+    return select(Book.__table__ if raw else Book).join(
+        books_fts,
+        books_fts.c.rowid == Book.book_id
+    ).where(
+        literal_column('books_fts').op('MATCH')(bindparam('search_query'))
+    ).order_by(
+        books_fts.c.rank
+    ).limit(bindparam('limit'))
+
+
+@lru_cache(maxsize=None)
+def most_popular_book_query() -> Select:
+    """(Book, row_count) rows, most borrowed first, counting books whose readers average above 4.
+    Counted from the daily rollup, which still holds the loans moved to the archive."""
+    return select(
+        Book,
+        func.sum(ReceivingStats.issues).label('row_count')
+    ).select_from(
+        ReceivingStats
+    ).join(
+        Student, Student.student_id == ReceivingStats.student_id
+    ).join(
+        Book, Book.book_id == ReceivingStats.book_id
+    ).group_by(
+        ReceivingStats.book_id
+    ).having(
+        Student.average_score > 4
+    ).order_by(
+        desc('row_count'),
+        desc(Book.count)
+    )
+
+
+author_available_query = select(func.sum(Book.available)).where(Book.author_id == bindparam('author_id'))
+
+student_exists_query = select(Student.student_id).where(Student.student_id == bindparam('student_id'))
+
+
+@lru_cache(maxsize=None)
+def recommendations_query() -> Select:
+    """(student_id, Book) pairs: books by the authors a student has read, minus the books they have already taken.
+    Loans of both tiers count. The student ids are bound as the expanding parameter student_ids."""
+    read_book = aliased(Book)
+
+    read_authors = union(*(
+        select(
+            loans.student_id,
+            read_book.author_id
+        ).join(
+            read_book,
+            read_book.book_id == loans.book_id
+        ).where(
+            loans.student_id.in_(bindparam('student_ids', expanding=True))
+        )
+        for loans in (ReceivingBooks, ArchivedLoan)
+    )).subquery()
+
+    already_taken = or_(*(
+        exists().where(
+            loans.student_id == read_authors.c.student_id,
+            loans.book_id == Book.book_id
+        )
+        for loans in (ReceivingBooks, ArchivedLoan)
+    ))
+
+    return select(
+        read_authors.c.student_id,
+        Book
+    ).select_from(
+        read_authors
+    ).join(
+        Book,
+        Book.author_id == read_authors.c.author_id
+    ).where(
+        ~already_taken
+    ).order_by(
+        read_authors.c.student_id,
+        Book.book_id
+    )
+
+
+def search_query_from(title: Optional[str]) -> str:
+    """Turns user input into an FTS5 query where every word is matched as a prefix"""
+    terms = SEARCH_TERM_PATTERN.findall(title or '')
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+@event.listens_for(Book.__table__, 'after_create')
+def create_search_index(target, connection: Connection, **kw: Any) -> None:
+    # An index built before the author insert/delete triggers may hold stale author names, it is rebuilt once
+    is_new = not inspect(connection).has_table('books_fts') or not connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'books_fts_after_author_insert'"
+    ).scalar()
+
+    for statement in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+
+    if is_new:
+        for statement in SEARCH_INDEX_REBUILD:
+            connection.exec_driver_sql(statement)
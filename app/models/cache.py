@@ -0,0 +1,149 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Hashable, Iterable, Optional, Tuple
+
+from module_21_orm_2.homework.app.models.changes import on_tables_changed
+
+ANALYTICS_CACHE_SIZE = int(os.environ.get('LIBRARY_ANALYTICS_CACHE_SIZE', 256))
+ANALYTICS_CACHE_TTL = float(os.environ.get('LIBRARY_ANALYTICS_CACHE_TTL', 300))
+
+
+class ResultCache:
+    """Thread-safe LRU cache with a TTL. Every entry names the tables it was computed from
+    and is dropped as soon as a transaction writing to one of them commits."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._entries: OrderedDict[Hashable, Tuple[float, FrozenSet[str], Any]] = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key: Hashable, tables: Iterable[str], factory: Callable[[], Any]) -> Any:
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+
+        generation = self._generation
+        value = factory()
+        self._store(key, tables, value, generation)
+        return value
+
+    async def get_or_set_async(
+            self,
+            key: Hashable,
+            tables: Iterable[str],
+            factory: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """get_or_set for coroutine factories, the lock is never held across an await"""
+        hit, value = self._lookup(key)
+        if hit:
+            return value
+
+        generation = self._generation
+        value = await factory()
+        self._store(key, tables, value, generation)
+        return value
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+
+            self.misses += 1
+            return False, None
+
+    def _store(self, key: Hashable, tables: Iterable[str], value: Any, generation: int) -> None:
+        with self._lock:
+            # A write committed while the value was computed, it may already be stale
+            if generation == self._generation:
+                self._entries[key] = (monotonic() + self.ttl, frozenset(tables), value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, tables: FrozenSet[str]) -> None:
+        with self._lock:
+            self._generation += 1
+            stale = [key for key, (_, depends_on, _) in self._entries.items() if depends_on & tables]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
+
+
+class TableVersions:
+    """Per-table counters bumped by every committed write, the validators of conditional GETs.
+    Like ResultCache they only see the writes of this process."""
+
+    def __init__(self):
+        # Counters restart with the process, the boot token keeps ETags of an earlier run from matching
+        self.boot = uuid.uuid4().hex[:8]
+        self.started_at = time()
+
+        self._versions: Dict[str, int] = dict()
+        self._changed_at: Dict[str, float] = dict()
+        self._lock = threading.Lock()
+
+    def bump(self, tables: FrozenSet[str]) -> None:
+        """Runs once the COMMIT has returned. Bumped any earlier, a response read from the old rows
+        could carry the new ETag and be confirmed with 304 until the next write."""
+        with self._lock:
+            changed_at = time()
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._changed_at[table] = changed_at
+
+    def etag(self, tables: Iterable[str], *varies: Any) -> str:
+        """Strong ETag of a response computed from tables, varies are the request-independent
+        inputs besides the data, e.g. the current date"""
+        with self._lock:
+            versions = '.'.join(f'{self._versions.get(table, 0)}' for table in tables)
+        parts = [self.boot, versions, *(f'{value}' for value in varies)]
+        return '-'.join(parts)
+
+    def last_modified(self, tables: Iterable[str]) -> Optional[datetime]:
+        """Time of the latest write to tables, None while its second is not over yet:
+        Last-Modified has a one second resolution and a later write in the same second would not change it"""
+        with self._lock:
+            changed_at = max(
+                (self._changed_at.get(table, self.started_at) for table in tables),
+                default=self.started_at
+            )
+
+        if int(changed_at) >= int(time()):
+            return None
+        return datetime.fromtimestamp(int(changed_at), tz=timezone.utc)
+
+
+analytics_cache = ResultCache(maxsize=ANALYTICS_CACHE_SIZE, ttl=ANALYTICS_CACHE_TTL)
+on_tables_changed(analytics_cache.invalidate)
+
+table_versions = TableVersions()
+on_tables_changed(table_versions.bump)
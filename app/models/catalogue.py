@@ -0,0 +1,325 @@
+import heapq
+import os
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+from module_21_orm_2.homework.app.models.author import Author
+from module_21_orm_2.homework.app.models.book import Book, SEARCH_LIMIT, SEARCH_TERM_PATTERN
+from module_21_orm_2.homework.app.models.changes import after_commit
+from module_21_orm_2.homework.app.models.init import engine, PAGE_LIMIT
+from module_21_orm_2.homework.app.models.receiving_books import checkin_query, checkout_query
+
+# In-process copy of books and authors for all_books, book_by_name and sum_of_books_by_author_id.
+# It only sees the writes of its own process, so it is off unless LIBRARY_CATALOGUE_SNAPSHOT=1 is set
+# for a single server process that makes every write to books and authors.
+CATALOGUE_SNAPSHOT = os.environ.get('LIBRARY_CATALOGUE_SNAPSHOT', '0') == '1'
+
+CATALOGUE_TABLES = frozenset({Book.__tablename__, Author.__tablename__})
+
+
+class BookRecord:
+    """One row of books, to_json gives the same mapping as the raw queries"""
+    __slots__ = ('book_id', 'name', 'count', 'available', 'release_date', 'author_id')
+
+    def __init__(self, book_id: int, name: str, count: int, available: int, release_date: date, author_id: int):
+        self.book_id = book_id
+        self.name = name
+        self.count = count
+        self.available = available
+        self.release_date = release_date
+        self.author_id = author_id
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'book_id': self.book_id,
+            'name': self.name,
+            'count': self.count,
+            'available': self.available,
+            'release_date': self.release_date,
+            'author_id': self.author_id
+        }
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, name) for name in BOOK_COLUMNS)
+
+
+BOOK_COLUMNS = BookRecord.__slots__
+
+
+class PrefixIndex:
+    """Folded words -> ids, looked up by prefix like the books_fts "term"* queries"""
+
+    def __init__(self, entries: Iterable[tuple]):
+        postings: Dict[str, Set[int]] = defaultdict(set)
+        for entry_id, text in entries:
+            for word in words_of(text):
+                postings[word].add(entry_id)
+
+        self.postings = dict(postings)
+        self.words = sorted(postings)
+
+    def matching(self, prefix: str) -> Set[int]:
+        ids = set()
+        for position in range(bisect_left(self.words, prefix), len(self.words)):
+            word = self.words[position]
+            if not word.startswith(prefix):
+                break
+            ids |= self.postings[word]
+        return ids
+
+
+class CatalogueSnapshot:
+    """Books and authors held in memory. Loan statements adjust the copy counters in place once their
+    COMMIT has returned, other writes to books or authors mark the snapshot stale and the next read
+    reloads it. Writes of other processes are not seen, verify() finds the drift they leave."""
+
+    def __init__(self, enabled: bool = CATALOGUE_SNAPSHOT):
+        self.enabled = enabled
+        self.loaded_at: Optional[datetime] = None
+        # Bumped by every reload, counter changes read before a reload are not added to the next copy
+        self.generation = 0
+        self.stale = False
+        self.reloads = 0
+        self.updates = 0
+
+        self._books: Dict[int, BookRecord] = dict()
+        # Sorted book ids, a keyset page is a slice of it
+        self._book_ids = array('q')
+        self._available_by_author: Dict[int, int] = dict()
+        self._books_by_author: Dict[int, List[int]] = dict()
+        self._titles = PrefixIndex(())
+        self._authors = PrefixIndex(())
+        self._lock = threading.Lock()
+        # Held for the whole first load, which waits for the database, never while holding _lock
+        self._load_lock = threading.Lock()
+
+    def load(self) -> None:
+        """Reads the catalogue holding the write lock of the database, so no loan can commit between
+        the read and the swap and get lost"""
+        with engine.connect() as connection:
+            if connection.dialect.name == 'sqlite':
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                self._load_from(connection)
+            finally:
+                connection.rollback()
+
+    def _load_from(self, connection: Connection) -> None:
+        books = {
+            row.book_id: BookRecord(*row)
+            for row in connection.execute(select(*(Book.__table__.c[name] for name in BOOK_COLUMNS)))
+        }
+        authors = connection.execute(select(Author.author_id, Author.name, Author.surname)).all()
+
+        available_by_author: Dict[int, int] = defaultdict(int)
+        books_by_author: Dict[int, List[int]] = defaultdict(list)
+        for book in books.values():
+            available_by_author[book.author_id] += book.available
+            books_by_author[book.author_id].append(book.book_id)
+
+        titles = PrefixIndex((book.book_id, book.name) for book in books.values())
+        authors = PrefixIndex((author_id, f'{name} {surname}') for author_id, name, surname in authors)
+
+        with self._lock:
+            self._books = books
+            self._book_ids = array('q', sorted(books))
+            self._available_by_author = dict(available_by_author)
+            self._books_by_author = dict(books_by_author)
+            self._titles = titles
+            self._authors = authors
+            self.loaded_at = datetime.now()
+            self.generation += 1
+            self.stale = False
+            self.reloads += 1
+
+    def _ensure_loaded(self) -> None:
+        if self.loaded_at is None or self.stale:
+            with self._load_lock:
+                if self.loaded_at is None or self.stale:
+                    self.load()
+
+    def mark_stale(self) -> None:
+        with self._lock:
+            self.stale = True
+
+    def apply(self, deltas: Dict[int, int], generation: int) -> None:
+        """Adds committed changes of Book.available read against the copy of generation. A reload since then
+        read the committed counters already: the loan held the write lock first, the reload had to wait for it."""
+        with self._lock:
+            if self.loaded_at is None or generation != self.generation:
+                return
+            for book_id, delta in deltas.items():
+                book = self._books.get(book_id)
+                if book is not None:
+                    book.available += delta
+                    self._available_by_author[book.author_id] += delta
+            self.updates += 1
+
+    def all_books(self, limit: int = PAGE_LIMIT, after: Optional[int] = None) -> List[Dict[str, Any]]:
+        self._ensure_loaded()
+        with self._lock:
+            start = bisect_left(self._book_ids, after + 1) if after is not None else 0
+            return [self._books[book_id].to_json() for book_id in self._book_ids[start:start + limit]]
+
+    def book_by_name(self, title: str, limit: int = SEARCH_LIMIT) -> List[Dict[str, Any]]:
+        """Books matching every word of title as a prefix of a title or author word, like Book.book_by_name.
+        Title matches rank first, then shorter titles; bm25 may order the ties differently."""
+        terms = [fold(term) for term in SEARCH_TERM_PATTERN.findall(title or '')]
+        if not terms:
+            return []
+
+        self._ensure_loaded()
+        with self._lock:
+            title_hits: Optional[Dict[int, int]] = None
+            for term in terms:
+                in_titles = self._titles.matching(term)
+                matched = set(in_titles)
+                for author_id in self._authors.matching(term):
+                    matched.update(self._books_by_author.get(author_id, ()))
+
+                if title_hits is None:
+                    title_hits = {book_id: int(book_id in in_titles) for book_id in matched}
+                else:
+                    title_hits = {
+                        book_id: hits + (book_id in in_titles)
+                        for book_id, hits in title_hits.items() if book_id in matched
+                    }
+                if not title_hits:
+                    return []
+
+            ranked = heapq.nsmallest(
+                limit if limit >= 0 else len(title_hits),
+                title_hits,
+                key=lambda book_id: (-title_hits[book_id], len(self._books[book_id].name), book_id)
+            )
+            return [self._books[book_id].to_json() for book_id in ranked]
+
+    def sum_of_books_by_author_id(self, author_id: int) -> Optional[int]:
+        """None for an author without books, as sum() over no rows"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._available_by_author.get(author_id)
+
+    def verify(self, repair: bool = False) -> Dict[str, Any]:
+        """Compares the snapshot with the books table, reloads it on a mismatch when repair is set.
+        Loans committing while it runs can show up as mismatches."""
+        self._ensure_loaded()
+        with engine.connect() as connection:
+            rows = {
+                row.book_id: tuple(row)
+                for row in connection.execute(select(*(Book.__table__.c[name] for name in BOOK_COLUMNS)))
+            }
+
+        with self._lock:
+            snapshot = {book_id: book.as_tuple() for book_id, book in self._books.items()}
+
+        report = {
+            'books': len(rows),
+            'missing': sorted(rows.keys() - snapshot.keys()),
+            'extra': sorted(snapshot.keys() - rows.keys()),
+            'mismatched': sorted(
+                book_id for book_id in rows.keys() & snapshot.keys() if rows[book_id] != snapshot[book_id]
+            )
+        }
+        report['consistent'] = not (report['missing'] or report['extra'] or report['mismatched'])
+
+        if repair and not report['consistent']:
+            self.load()
+        return report
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'books': len(self._books),
+                'loaded_at': self.loaded_at.isoformat(timespec='seconds') if self.loaded_at else None,
+                'stale': self.stale,
+                'reloads': self.reloads,
+                'updates': self.updates
+            }
+
+
+@lru_cache(maxsize=65536)
+def fold(word: str) -> str:
+    """Case and Latin diacritics folded away, close to the unicode61 tokenizer of books_fts"""
+    if word.isascii():
+        return word.lower()
+
+    folded = list()
+    for char in word.casefold():
+        base = unicodedata.normalize('NFD', char)[0]
+        folded.append(base if ord(base) < 0x250 else char)
+    return ''.join(folded)
+
+
+def words_of(text: Optional[str]) -> List[str]:
+    return [fold(word) for word in SEARCH_TERM_PATTERN.findall(text or '')]
+
+
+catalogue = CatalogueSnapshot()
+
+
+def collect_catalogue_writes(conn: Connection, clauseelement: Any, multiparams, params, execution_options, result):
+    if not isinstance(clauseelement, UpdateBase) or clauseelement.table.name not in CATALOGUE_TABLES:
+        return
+
+    if clauseelement is checkout_query or clauseelement is checkin_query:
+        parameters = multiparams or [params]
+        # The loan paths roll back when a counter update misses a row, a partial batch is settled by a reload
+        if result.rowcount == len(parameters):
+            # The statement holds the write lock, no reload is running and the generation stays until the COMMIT
+            conn.info.setdefault('catalogue_generation', catalogue.generation)
+            deltas = conn.info.setdefault('catalogue_deltas', defaultdict(int))
+            for parameter in parameters:
+                if clauseelement is checkout_query:
+                    deltas[parameter['checkout_book_id']] -= parameter['taken']
+                else:
+                    deltas[parameter['checkin_book_id']] += parameter['returned']
+            return
+
+    conn.info['catalogue_reload'] = True
+
+
+def publish_catalogue_writes(conn: Any, committed: bool) -> None:
+    # Runs once the COMMIT has returned, a failed one leaves the snapshot as it was
+    deltas = conn.info.pop('catalogue_deltas', None)
+    generation = conn.info.pop('catalogue_generation', None)
+    reload = conn.info.pop('catalogue_reload', False)
+    if not committed:
+        return
+
+    # A reload here would hold up the committing request, the next read does it instead
+    if reload:
+        catalogue.mark_stale()
+    elif deltas:
+        catalogue.apply(deltas, generation)
+
+
+def discard_catalogue_writes(conn: Connection) -> None:
+    conn.info.pop('catalogue_deltas', None)
+    conn.info.pop('catalogue_generation', None)
+    conn.info.pop('catalogue_reload', None)
+
+
+def watch_engine(watched: Engine) -> None:
+    """Keeps the snapshot current with the commits of a writer engine,
+    an AsyncEngine is watched through its sync_engine"""
+    if not catalogue.enabled:
+        return
+    event.listen(watched, 'after_execute', collect_catalogue_writes)
+    # Ahead of the table versions: a request tagged with the new ETag has to find the commit in the snapshot
+    after_commit(watched, publish_catalogue_writes, first=True)
+    event.listen(watched, 'rollback', discard_catalogue_writes)
+
+
+watch_engine(engine)
@@ -0,0 +1,81 @@
+from typing import Any, Callable, FrozenSet, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+from module_21_orm_2.homework.app.models.init import engine
+
+TablesListener = Callable[[FrozenSet[str]], None]
+# Gets the pooled connection whose transaction ended and whether its COMMIT went through
+CommitListener = Callable[[Any, bool], None]
+
+_listeners: List[TablesListener] = list()
+
+
+def on_tables_changed(listener: TablesListener) -> TablesListener:
+    """Registers a callback that gets the names of the tables written by every committed transaction"""
+    _listeners.append(listener)
+    return listener
+
+
+def collect_written_tables(conn: Connection, clauseelement: Any, multiparams, params, execution_options, result):
+    # ORM flushes, ORM-enabled DML and Core statements all reach the connection as INSERT/UPDATE/DELETE constructs
+    if isinstance(clauseelement, UpdateBase):
+        conn.info.setdefault('written_tables', set()).add(clauseelement.table.name)
+
+
+def mark_written(conn: Connection, *tables: str) -> None:
+    """Records tables written by raw SQL, which collect_written_tables does not see, for the next commit"""
+    conn.info.setdefault('written_tables', set()).update(tables)
+
+
+def after_commit(watched: Engine, listener: CommitListener, first: bool = False) -> None:
+    """Calls listener once the COMMIT of every transaction on the engine has returned. The engine 'commit'
+    event fires before the COMMIT, a request reading in between would still see the old rows and could
+    cache them or tag them with the new versions. first puts the listener ahead of those registered before it."""
+    dialect = watched.dialect
+    listeners = dialect.__dict__.get('after_commit_listeners')
+    if listeners is None:
+        listeners = dialect.after_commit_listeners = list()
+        do_commit = dialect.do_commit
+
+        def do_commit_and_notify(dbapi_connection) -> None:
+            try:
+                do_commit(dbapi_connection)
+            except BaseException:
+                for notify in listeners:
+                    notify(dbapi_connection, False)
+                raise
+            for notify in listeners:
+                notify(dbapi_connection, True)
+
+        dialect.do_commit = do_commit_and_notify
+
+    if first:
+        listeners.insert(0, listener)
+    else:
+        listeners.append(listener)
+
+
+def publish_written_tables(conn: Any, committed: bool) -> None:
+    # conn is the pooled connection, it shares its info dict with the Connection that collected the tables
+    tables = conn.info.pop('written_tables', None)
+    if tables and committed:
+        tables = frozenset(tables)
+        for listener in _listeners:
+            listener(tables)
+
+
+def discard_written_tables(conn: Connection) -> None:
+    conn.info.pop('written_tables', None)
+
+
+def track_engine(tracked: Engine) -> None:
+    """Publishes the commits of another writer engine too, an AsyncEngine is tracked through its sync_engine"""
+    event.listen(tracked, 'after_execute', collect_written_tables)
+    after_commit(tracked, publish_written_tables)
+    event.listen(tracked, 'rollback', discard_written_tables)
+
+
+track_engine(engine)
@@ -1,10 +1,96 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+import os
 
-engine = create_engine('sqlite:///library.db', echo=False)
-Session = sessionmaker(bind=engine)
-session = Session()
+from typing import Any, Dict, Optional, Sequence, Union
+
+from sqlalchemy import QueuePool, Select, create_engine, event, make_url
+from sqlalchemy.engine import Engine, RowMapping, URL
+from sqlalchemy.orm import DeclarativeBase, Session as BaseSession, sessionmaker, scoped_session
+
+DATABASE_URL = os.environ.get('LIBRARY_DATABASE_URL', 'sqlite:///library.db')
+# Defaults to a read-only URI connection to the same SQLite file, see read_only_url
+READ_DATABASE_URL = os.environ.get('LIBRARY_READ_DATABASE_URL')
+POOL_SIZE = int(os.environ.get('LIBRARY_POOL_SIZE', 10))
+POOL_MAX_OVERFLOW = int(os.environ.get('LIBRARY_POOL_MAX_OVERFLOW', 20))
+POOL_TIMEOUT = float(os.environ.get('LIBRARY_POOL_TIMEOUT', 30))
+READ_POOL_SIZE = int(os.environ.get('LIBRARY_READ_POOL_SIZE', POOL_SIZE))
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('LIBRARY_SQLITE_BUSY_TIMEOUT', 15))
+SQLITE_JOURNAL_MODE = os.environ.get('LIBRARY_SQLITE_JOURNAL_MODE', 'WAL')
+
+PAGE_LIMIT = int(os.environ.get('LIBRARY_PAGE_LIMIT', 100))
+STREAM_BATCH_SIZE = int(os.environ.get('LIBRARY_STREAM_BATCH_SIZE', 1000))
+
+
+def read_only_url(url: Union[str, URL]) -> Optional[URL]:
+    """sqlite:///library.db -> sqlite:///file:library.db?mode=ro&uri=true.
+    None for in-memory databases and other backends, those are read through the writer engine."""
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.set(database=f'file:{url.database}', query={**url.query, 'mode': 'ro', 'uri': 'true'})
+
+
+def engine_options(url: Union[str, URL], pool_size: int = POOL_SIZE) -> Dict[str, Any]:
+    """create_engine arguments for url. Pool sizing only applies to the queue pools of file databases
+    and servers, in-memory SQLite gets a single-connection pool; the busy timeout is a sqlite3 argument."""
+    url = make_url(url)
+    options: Dict[str, Any] = {'echo': False}
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options.update(pool_size=pool_size, max_overflow=POOL_MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT)
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'timeout': SQLITE_BUSY_TIMEOUT}
+    return options
+
+
+def make_engine(url: Union[str, URL], pool_size: int = POOL_SIZE) -> Engine:
+    return create_engine(url, **engine_options(url, pool_size))
+
+
+engine = make_engine(DATABASE_URL)
+
+_read_url = READ_DATABASE_URL or read_only_url(engine.url)
+read_engine = make_engine(_read_url, READ_POOL_SIZE) if _read_url else engine
+
+
+@event.listens_for(engine, 'connect')
+def set_journal_mode(dbapi_connection, connection_record) -> None:
+    # WAL lets readers run next to a writer. The mode is stored in the database file,
+    # read-only connections cannot switch it and pick it up from there.
+    if engine.dialect.name == 'sqlite' and SQLITE_JOURNAL_MODE:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+        cursor.close()
+
+
+class RoutingSession(BaseSession):
+    """Sends everything to the writer engine unless the session is flagged read-only
+    with session.info['read_only'] = True, the web layer does that for GET requests"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kw: Any):
+        if bind is not None:
+            return bind
+        if self.info.get('read_only'):
+            return read_engine
+        return engine
+
+
+Session = sessionmaker(class_=RoutingSession)
+
+# Every thread (and so every Flask request) gets its own session from the registry.
+# The web layer closes it at request teardown with `session.remove()`.
+session = scoped_session(Session)
 
 
 class Base(DeclarativeBase):
     pass
+
+
+def fetch_all(
+        query: Select,
+        raw: bool = False,
+        params: Optional[Dict[str, Any]] = None
+) -> Union[Sequence[Any], Sequence[RowMapping]]:
+    """raw=True skips ORM hydration and the identity map: the rows come back as plain Core mappings.
+    Read-only endpoints use it together with serializers.dumps."""
+    if raw:
+        return session.execute(query, params).mappings().all()
+    return session.scalars(query, params).all()
@@ -0,0 +1,34 @@
+import os
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, Index, func
+from sqlalchemy.orm import Mapped, mapped_column
+
+from module_21_orm_2.homework.app.models.init import Base
+
+# Loans returned longer ago than this leave receiving_books with `flask archive-loans`
+ARCHIVE_AFTER_DAYS = int(os.environ.get('LIBRARY_ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('LIBRARY_ARCHIVE_BATCH_SIZE', 5000))
+
+
+class ArchivedLoan(Base):
+    """Returned loans moved out of receiving_books, with the same columns in the same order and the same receipt ids.
+    History and statistics queries read both tables, checkouts and returns only the small one."""
+    __tablename__ = 'receiving_books_archive'
+
+    receipt_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    book_id: Mapped[int] = mapped_column(ForeignKey('books.book_id'))
+    student_id: Mapped[int] = mapped_column(ForeignKey('students.student_id'))
+    date_of_issue: Mapped[datetime]
+    date_of_return: Mapped[datetime]
+
+    __table_args__ = (
+        Index('ix_receiving_books_archive_date_of_issue_student_id', 'date_of_issue', 'student_id'),
+        Index('ix_receiving_books_archive_student_id_book_id', 'student_id', 'book_id'),
+    )
+
+
+archived_loan_days = func.julianday(ArchivedLoan.date_of_return) - func.julianday(ArchivedLoan.date_of_issue)
+
+# Same expression index as ix_receiving_books_closed_loan_days, for the late returns of the debtors list
+Index('ix_receiving_books_archive_loan_days', archived_loan_days)
@@ -0,0 +1,52 @@
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection
+
+from module_21_orm_2.homework.app.models.book import Book, create_search_index, recount_available_query
+from module_21_orm_2.homework.app.models.init import Base, engine
+from module_21_orm_2.homework.app.models.receiving_books import ReceivingBooks
+from module_21_orm_2.homework.app.models.receiving_stats import create_rollup_triggers
+
+# Keeps the first open loan of every (book, student) pair and closes the rest on their issue date,
+# the unique open-loans index cannot be built while racing checkouts have left duplicates behind
+CLOSE_DUPLICATE_OPEN_LOANS = (
+    "UPDATE receiving_books SET date_of_return = date_of_issue "
+    "WHERE date_of_return IS NULL AND receipt_id NOT IN ("
+    "SELECT min(receipt_id) FROM receiving_books WHERE date_of_return IS NULL GROUP BY book_id, student_id)"
+)
+
+
+def upgrade(connection: Connection) -> None:
+    """Brings a database created by an older version of the models up to date.
+    Base.metadata.create_all only creates missing tables, it never alters existing ones."""
+    book_columns = {col['name'] for col in inspect(connection).get_columns('books')}
+
+    if 'available' not in book_columns:
+        connection.exec_driver_sql('ALTER TABLE books ADD COLUMN available INTEGER NOT NULL DEFAULT 1')
+        connection.execute(recount_available_query())
+
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_books_author_id')
+
+    # The inspector does not report expression indexes, so existing names are read from sqlite_master
+    existing_indexes = set(connection.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index'"
+    ).scalars())
+
+    if 'uq_receiving_books_open_loans' not in existing_indexes:
+        connection.exec_driver_sql('DROP INDEX IF EXISTS ix_receiving_books_open_loans')
+        if connection.exec_driver_sql(CLOSE_DUPLICATE_OPEN_LOANS).rowcount:
+            connection.execute(recount_available_query())
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(connection)
+
+    create_search_index(Book.__table__, connection)
+    create_rollup_triggers(ReceivingBooks.__table__, connection)
+
+
+def init_database() -> None:
+    """Creates missing tables and upgrades the existing ones, safe to run on every deploy"""
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        upgrade(connection)
@@ -1,12 +1,14 @@
 import random
 from datetime import date, datetime, timedelta
 from statistics import mean
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
-from sqlalchemy import select
+from sqlalchemy import select, insert, func, exists
+from sqlalchemy.engine import Connection
 
 from module_21_orm_2.homework.app.models.author import Author
-from module_21_orm_2.homework.app.models.book import Book
-from module_21_orm_2.homework.app.models.init import session
+from module_21_orm_2.homework.app.models.book import Book, recount_available_query
+from module_21_orm_2.homework.app.models.init import engine
 from module_21_orm_2.homework.app.models.receiving_books import ReceivingBooks
 from module_21_orm_2.homework.app.models.student import Student
 
@@ -18,153 +20,229 @@ def random_date(start, end):
     return start + timedelta(seconds=random_second)
 
 
-def insert_data():
-    if not session.scalars(select(Author)).all():
+SEED_AUTHORS = [
+    ('Лев', 'Толстой', [
+        ('Война и мир', date(1867, 1, 1)),
+        ('Анна Каренина', date(1873, 1, 1)),
+        ('Чем люди живы', date(1885, 1, 1)),
+    ]),
+    ('Уильям', 'Шекспир', [
+        ('Гамлет', date(1601, 1, 1)),
+        ('Ромео и Джульетта', date(1595, 1, 1)),
+        ('Макбет', date(1606, 1, 1)),
+    ]),
+    ('Владимир', 'Набоков', [
+        ('Лолита', date(1955, 1, 1)),
+    ]),
+    ('Фёдор', 'Достоевский', [
+        ('Преступление и наказание', date(1866, 1, 1)),
+        ('Братья Карамазовы', date(1880, 1, 1)),
+    ]),
+    ('Чарльз', 'Диккенс', [
+        ('Тяжелые времена', date(1854, 1, 1)),
+    ]),
+    ('Антон', 'Чехов', [
+        ('Хамелеон', date(1884, 1, 1)),
+        ('Мальчики', date(1887, 1, 1)),
+    ]),
+    ('Джейн', 'Остин', [
+        ('Гордость и предубеждение', date(1813, 1, 1)),
+    ]),
+]
+SEED_STUDENTS = [
+    'David Phillips',
+    'David Kelly',
+    'Thomas Simmons',
+    'Joseph Hammond',
+    'Marie McBride',
+    'Michelle Walker',
+    'James Huff',
+    'Patrick Ramirez',
+    'Dorothy James',
+    'Heidi Hodges',
+]
+SEED_RECEIPTS = 15
 
-        authors_list = [
-            Author(name='Лев', surname='Толстой'),
-            Author(name='Уильям', surname='Шекспир'),
-            Author(name='Владимир', surname='Набоков'),
-            Author(name='Фёдор', surname='Достоевский'),
-            Author(name='Чарльз', surname='Диккенс'),
-            Author(name='Антон', surname='Чехов'),
-            Author(name='Джейн', surname='Остин')
+
+def insert_data() -> bool:
+    """Seeds the demo library into an empty database with Core inserts in one transaction.
+    Returns False without writing anything when the database already has authors."""
+    with engine.begin() as connection:
+        if connection.scalar(select(exists().select_from(Author.__table__))):
+            return False
+
+        first_author = _next_id(connection, Author.author_id)
+        first_book = _next_id(connection, Book.book_id)
+        first_student = _next_id(connection, Student.student_id)
+
+        author_rows = list()
+        book_rows = list()
+        for author_id, (name, surname, books) in enumerate(SEED_AUTHORS, start=first_author):
+            author_rows.append({'author_id': author_id, 'name': name, 'surname': surname})
+            for title, release_date in books:
+                count = random.randint(1, 10)
+                book_rows.append({
+                    'book_id': first_book + len(book_rows),
+                    'name': title,
+                    'count': count,
+                    'available': count,
+                    'release_date': release_date,
+                    'author_id': author_id
+                })
+
+        student_rows = [
+            {
+                'student_id': student_id,
+                'name': names.split()[0],
+                'surname': names.split()[1],
+                'phone': '+79' + ''.join(str(random.randint(0, 9)) for _ in range(9)),
+                'email': f"testemail{student_id}@{random.choice(['mail', 'inbox', 'yandex', 'bk'])}.ru",
+                'average_score': round(mean([random.randint(1, 10) for _ in range(30)]), 2),
+                'scholarship': bool(random.getrandbits(1))
+            }
+            for student_id, names in enumerate(SEED_STUDENTS, start=first_student)
         ]
-        books_list = [
-            [
-                Book(
-                    title='Война и мир',
-                    count=random.randint(1, 10),
-                    release_date=date(1867, 1, 1)
-                ),
-                Book(
-                    title='Анна Каренина',
-                    count=random.randint(1, 10),
-                    release_date=date(1873, 1, 1)
-                ),
-                Book(
-                    title='Чем люди живы',
-                    count=random.randint(1, 10),
-                    release_date=date(1885, 1, 1)
-                )
-            ],
-            [
-                Book(
-                    title='Гамлет',
-                    count=random.randint(1, 10),
-                    release_date=date(1601, 1, 1)
-                ),
-                Book(
-                    title='Ромео и Джульетта',
-                    count=random.randint(1, 10),
-                    release_date=date(1595, 1, 1)
-                ),
-                Book(
-                    title='Макбет',
-                    count=random.randint(1, 10),
-                    release_date=date(1606, 1, 1)
-                )
-            ],
-            [
-                Book(
-                    title='Лолита',
-                    count=random.randint(1, 10),
-                    release_date=date(1955, 1, 1)
-                )
 
-            ],
-            [
-                Book(
-                    title='Преступление и наказание',
-                    count=random.randint(1, 10),
-                    release_date=date(1866, 1, 1)
+        # Ids are known up front, receipts draw from them instead of reading the tables back
+        book_ids = [row['book_id'] for row in book_rows]
+        student_ids = [row['student_id'] for row in student_rows]
+        receipt_rows = [
+            {
+                'book_id': random.choice(book_ids),
+                'student_id': random.choice(student_ids),
+                'date_of_issue': random_date(
+                    datetime(2024, 6, 15, 12, 00),
+                    datetime(2024, 7, 10, 17, 00)
                 ),
-                Book(
-                    title='Братья Карамазовы',
-                    count=random.randint(1, 10),
-                    release_date=date(1880, 1, 1)
-                )
-            ],
-            [
-                Book(
-                    title='Тяжелые времена',
-                    count=random.randint(1, 10),
-                    release_date=date(1854, 1, 1)
-                )
-            ],
-            [
-                Book(
-                    title='Хамелеон',
-                    count=random.randint(1, 10),
-                    release_date=date(1884, 1, 1)
-                ),
-                Book(
-                    title='Мальчики',
-                    count=random.randint(1, 10),
-                    release_date=date(1887, 1, 1)
-                )
-            ],
-            [
-                Book(
-                    title='Гордость и предубеждение',
-                    count=random.randint(1, 10),
-                    release_date=date(1813, 1, 1)
+                'date_of_return': random.choice(
+                    [
+                        random_date(
+                            datetime(2024, 7, 11, 12, 00),
+                            datetime.now()
+                        ),
+                        None
+                    ]
                 )
-            ],
-
+            }
+            for _ in range(SEED_RECEIPTS)
         ]
 
-        for author, book in zip(authors_list, books_list):
-            author.books.extend(book)
-        session.add_all(authors_list)
-
-        student_names = [
-            'David Phillips',
-            'David Kelly',
-            'Thomas Simmons',
-            'Joseph Hammond',
-            'Marie McBride',
-            'Michelle Walker',
-            'James Huff',
-            'Patrick Ramirez',
-            'Dorothy James',
-            'Heidi Hodges',
-        ]
-        students_list = [
-            Student(
-                name=names.split()[0],
-                surname=names.split()[1],
-                phone=f'+79{''.join([str(random.randint(0, 9)) for _ in range(9)])}',
-                email=f'testemail{random.randint(1, 100)}@{random.choice(['mail', 'inbox', 'yandex', 'bk'])}.ru',
-                average_score=round(mean([random.randint(1, 10) for _ in range(30)]), 2),
-                scholarship=bool(random.getrandbits(1))
-            )
-            for names in student_names
-        ]
+        connection.execute(insert(Author.__table__), author_rows)
+        connection.execute(insert(Book.__table__), book_rows)
+        connection.execute(insert(Student.__table__), student_rows)
+        # Random pairs may repeat, OR IGNORE keeps one open loan per pair as the unique index requires
+        connection.execute(insert(ReceivingBooks.__table__).prefix_with('OR IGNORE'), receipt_rows)
+        connection.execute(recount_available_query())
 
-        session.add_all(students_list)
+    return True
 
-        receipts_list = list()
-        for _ in range(15):
-            receipt = ReceivingBooks(
-                book=random.choice([b[0] for b in session.query(Book.book_id).all()]),
-                student=random.choice([s[0] for s in session.query(Student.student_id).all()])
-            )
-            receipt.date_of_issue = random_date(
-                datetime(2024, 6, 15, 12, 00),
-                datetime(2024, 7, 10, 17, 00)
-            )
-            receipt.date_of_return = random.choice(
-                [
-                    random_date(
-                        datetime(2024, 7, 11, 12, 00),
-                        datetime.now()
-                    ),
-                    None
-                ]
+
+GENERATOR_BATCH_SIZE = 50_000
+GENERATOR_OPEN_LOANS_SHARE = 0.1
+GENERATOR_HISTORY_DAYS = 3 * 365
+GENERATOR_TITLE_WORDS = ['война', 'мир', 'история', 'сад', 'море', 'город', 'время', 'дорога', 'дом', 'ночь']
+
+
+def generate_data(
+        authors: int = 10_000,
+        books: int = 1_000_000,
+        students: int = 200_000,
+        receipts: int = 10_000_000,
+        batch_size: int = GENERATOR_BATCH_SIZE,
+        seed: Optional[int] = None
+) -> Dict[str, int]:
+    """Appends a synthetic dataset of the given size with Core executemany inserts in one transaction.
+    Primary keys are assigned here, so the rows can reference each other without reading anything back."""
+    rnd = random.Random(seed)
+    now = datetime.now()
+
+    with engine.begin() as connection:
+        first_author = _next_id(connection, Author.author_id)
+        first_book = _next_id(connection, Book.book_id)
+        first_student = _next_id(connection, Student.student_id)
+
+        def author_row(i: int) -> Dict[str, Any]:
+            return {'author_id': first_author + i, 'name': f'Name{i}', 'surname': f'Surname{i}'}
+
+        def book_row(i: int) -> Dict[str, Any]:
+            count = rnd.randint(1, 10)
+            return {
+                'book_id': first_book + i,
+                'name': f'Book {first_book + i} {rnd.choice(GENERATOR_TITLE_WORDS)}',
+                'count': count,
+                'available': count,
+                'release_date': date(rnd.randint(1600, 2024), 1, 1),
+                'author_id': first_author + rnd.randrange(authors)
+            }
+
+        def student_row(i: int) -> Dict[str, Any]:
+            student_id = first_student + i
+            return {
+                'student_id': student_id,
+                'name': f'Student{student_id}',
+                'surname': f'Surname{student_id % 1000}',
+                'phone': f'+79{student_id:09d}',
+                'email': f'student{student_id}@example.ru',
+                'average_score': round(rnd.uniform(1, 10), 2),
+                'scholarship': rnd.random() < 0.5
+            }
+
+        def receipt_row(_: int) -> Dict[str, Any]:
+            date_of_issue = now - timedelta(seconds=rnd.randrange(GENERATOR_HISTORY_DAYS * 24 * 60 * 60))
+            date_of_return = None
+            if rnd.random() >= GENERATOR_OPEN_LOANS_SHARE:
+                date_of_return = min(date_of_issue + timedelta(days=rnd.uniform(1, 60)), now)
+            return {
+                'book_id': first_book + rnd.randrange(books),
+                'student_id': first_student + rnd.randrange(students),
+                'date_of_issue': date_of_issue,
+                'date_of_return': date_of_return
+            }
+
+        _insert_in_batches(connection, Author, author_row, authors, batch_size)
+        _insert_in_batches(connection, Book, book_row, books, batch_size)
+        _insert_in_batches(connection, Student, student_row, students, batch_size)
+        if books and students:
+            # A repeated open (book, student) pair is skipped, so the count may end up a little lower
+            receipts = _insert_in_batches(
+                connection, ReceivingBooks, receipt_row, receipts, batch_size, ignore_conflicts=True
             )
-            receipts_list.append(receipt)
+        else:
+            receipts = 0
+
+        connection.execute(recount_available_query())
+
+    return {'authors': authors, 'books': books, 'students': students, 'receipts': receipts}
+
+
+def _next_id(connection: Connection, primary_key) -> int:
+    return (connection.scalar(select(func.max(primary_key))) or 0) + 1
+
+
+def _insert_in_batches(
+        connection: Connection,
+        model,
+        make_row: Callable[[int], Dict[str, Any]],
+        total: int,
+        batch_size: int,
+        ignore_conflicts: bool = False
+) -> int:
+    statement = insert(model.__table__)
+    if ignore_conflicts:
+        statement = statement.prefix_with('OR IGNORE')
+
+    inserted = 0
+    for batch in _batches(map(make_row, range(total)), batch_size):
+        inserted += connection.execute(statement, batch).rowcount
+    return inserted
 
-        session.add_all(receipts_list)
 
-        session.commit()
+def _batches(rows: Iterator[Dict[str, Any]], batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = list()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
@@ -1,14 +1,31 @@
-from datetime import datetime
-from typing import Any, List, Tuple, Dict, Optional
+from collections import Counter, defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Any, List, Tuple, Dict, Optional, Sequence, Union
 
-from sqlalchemy import ForeignKey, case, func, extract, select, desc, update, insert
-from sqlalchemy.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy import (
+    ForeignKey, Index, ColumnElement, CompoundSelect, Select, bindparam, case, delete, event, func, insert,
+    literal_column, select, update, table, column, text, and_, or_, union_all
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Result, RowMapping
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 
-from module_21_orm_2.homework.app.models.init import Base, session
+from module_21_orm_2.homework.app.models.author import Author
+from module_21_orm_2.homework.app.models.init import Base, session, PAGE_LIMIT, STREAM_BATCH_SIZE
+from module_21_orm_2.homework.app.models.loan_archive import (
+    ArchivedLoan, archived_loan_days, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+)
+from module_21_orm_2.homework.app.models.receiving_stats import (
+    avg_issues_query, create_rollup_triggers, most_reading_students_query
+)
 from module_21_orm_2.homework.app.models.student import Student
 
+DEBT_DAYS = 14
+
+# books is declared in book.py, which imports this module, so the copy counter is reached through a table clause
+books = table('books', column('book_id'), column('name'), column('author_id'), column('available'))
+
 
 class ReceivingBooks(Base):
     __tablename__ = 'receiving_books'
@@ -16,11 +33,34 @@ class ReceivingBooks(Base):
     receipt_id: Mapped[int] = mapped_column(primary_key=True)
     book_id: Mapped[int] = mapped_column(ForeignKey('books.book_id'))
     student_id: Mapped[int] = mapped_column(ForeignKey('students.student_id'))
-    date_of_issue: Mapped[datetime] = mapped_column(default=datetime.now())
+    date_of_issue: Mapped[datetime] = mapped_column(default=datetime.now)
     date_of_return: Mapped[Optional[datetime]]
 
-    book = relationship('Book', back_populates='students')
-    student = relationship('Student', back_populates='books')
+    book = relationship('Book', back_populates='students', lazy='raise_on_sql')
+    student = relationship('Student', back_populates='books', lazy='raise_on_sql')
+
+    __table_args__ = (
+        # A student holds at most one open loan of a book, concurrent checkouts of the same pair conflict here
+        Index(
+            'uq_receiving_books_open_loans',
+            'book_id', 'student_id',
+            unique=True,
+            sqlite_where=text('date_of_return IS NULL')
+        ),
+        Index(
+            'ix_receiving_books_open_date_of_issue',
+            'date_of_issue',
+            sqlite_where=text('date_of_return IS NULL')
+        ),
+        # Open loans in receipt id order, the first arm of debtor_loans
+        Index(
+            'ix_receiving_books_open_receipt_id',
+            'receipt_id',
+            sqlite_where=text('date_of_return IS NULL')
+        ),
+        Index('ix_receiving_books_date_of_issue_student_id', 'date_of_issue', 'student_id'),
+        Index('ix_receiving_books_student_id_book_id', 'student_id', 'book_id'),
+    )
 
     def __init__(self, book, student, **kw: Any):
         super().__init__(**kw)
@@ -51,88 +91,371 @@ class ReceivingBooks(Base):
         return func.julianday(end_date) - func.julianday(cls.date_of_issue)
 
     @classmethod
-    def add_receipt(cls, book, student) -> Tuple[str, int]:
-        query = select(ReceivingBooks).where(
-            ReceivingBooks.book_id == book,
-            ReceivingBooks.student_id == student,
-            ReceivingBooks.date_of_return == None
+    def debt_condition(cls) -> ColumnElement[bool]:
+        """Same loans as `count_date_with_book > DEBT_DAYS`, written so that both branches hit an index"""
+        cutoff = datetime.now() - timedelta(days=DEBT_DAYS)
+        return or_(
+            and_(cls.date_of_return == None, cls.date_of_issue < cutoff),
+            late_return
         )
-        if session.scalars(query).first():
+
+    @classmethod
+    def add_receipt(cls, book, student) -> Tuple[str, int]:
+        # The loan is inserted first: an open loan of the same pair, even one committed a moment ago
+        # by another request, turns the insert into a no-op instead of a second open loan
+        new_receipt = {'book_id': book, 'student_id': student, 'date_of_issue': datetime.now()}
+        if not session.execute(new_receipt_query, new_receipt).rowcount:
+            session.rollback()
             return f'A student with id {student} has already taken a book with id {book}', 400
-        else:
-            new_receipt = insert(ReceivingBooks).values(book_id=book, student_id=student)
 
-            session.execute(new_receipt)
-            session.commit()
+        if not session.execute(checkout_query, {'checkout_book_id': book, 'taken': 1}).rowcount:
+            session.rollback()
+            return f'There are no available copies of the book with id {book}', 400
+
+        session.commit()
 
-            return f'Book with id {book} issued to student {student}', 201
+        return f'Book with id {book} issued to student {student}', 201
 
     @classmethod
-    def avg_count_of_receiving_books(cls, cur_month: int) -> float:
-        sub_query = select(
-            func.count(ReceivingBooks.book_id).label('row_count')
-        ).group_by(
-            ReceivingBooks.student_id
-        ).having(
-            extract('month', ReceivingBooks.date_of_issue) == cur_month
-        ).subquery()
+    def avg_count_of_receiving_books(cls, cur_month: int, cur_year: Optional[int] = None) -> float:
+        start, end = month_bounds(cur_year or datetime.now().year, cur_month)
+        return session.scalar(avg_issues_query, {'start': start, 'end': end})
 
-        result = session.scalar(func.avg(sub_query.c.row_count))
+    @classmethod
+    def debtors_list(
+            cls,
+            limit: int = PAGE_LIMIT,
+            after: Optional[int] = None,
+            raw: bool = False
+    ) -> Union[List['ReceivingBooks'], Sequence[RowMapping]]:
+        """Archived late returns come back as ReceivingBooks objects too, they are only meant to be read"""
+        query = cls.debtor_loans(after).limit(limit)
+        if raw:
+            return session.execute(query).mappings().all()
+        return session.scalars(select(ReceivingBooks).from_statement(query)).all()
 
-        return result
+    @classmethod
+    def stream_debtors(cls, after: Optional[int] = None, batch_size: int = STREAM_BATCH_SIZE) -> Result:
+        query = cls.debtor_loans(after).execution_options(yield_per=batch_size)
+        return session.execute(query).mappings()
 
     @classmethod
-    def debtors_list(cls) -> Optional[List['ReceivingBooks']]:
-        days = 14
-        query = select(ReceivingBooks).where(ReceivingBooks.count_date_with_book > days)
-        return session.scalars(query).all()
+    def debtor_loans(cls, after: Optional[int] = None) -> CompoundSelect:
+        """Loans matching debt_condition in both tiers by receipt id, archived loans can only be late returns.
+        Each arm walks a partial index in receipt id order and the compound merges them, so a page reads
+        about limit rows however few debtors there are; one OR over receiving_books walks the primary key."""
+        cutoff = datetime.now() - timedelta(days=DEBT_DAYS)
+        arms = [
+            select(ReceivingBooks.__table__).where(cls.date_of_return == None, cls.date_of_issue < cutoff),
+            select(ReceivingBooks.__table__).where(late_return),
+            select(ArchivedLoan.__table__).where(archived_late_return)
+        ]
+        if after is not None:
+            arms = [arm.where(arm.selected_columns.receipt_id > after) for arm in arms]
+        return union_all(*arms).order_by('receipt_id')
 
     @classmethod
-    def most_reading_students(cls, cur_year: int) -> Optional[List[Tuple['Student', int]]]:
-        query = select(
-            Student,
-            func.count(ReceivingBooks.date_of_issue).label('row_count')
-        ).join(
-            ReceivingBooks,
-            Student.books
-        ).group_by(
-            ReceivingBooks.student_id
-        ).having(
-            extract('year', ReceivingBooks.date_of_issue) == cur_year
-        ).order_by(
-            desc('row_count'),
-            desc(func.count(ReceivingBooks.date_of_return))
-        )
+    def loans_export(
+            cls,
+            date_from: Optional[date] = None,
+            date_to: Optional[date] = None,
+            debtors_only: bool = False,
+            batch_size: int = STREAM_BATCH_SIZE
+    ) -> Result:
+        """Loans issued between date_from and date_to inclusive from both tiers, joined with student and book details.
+        Rows come from a yield_per cursor in batch_size partitions, so an export never holds every loan in memory."""
+        current = loans_export_query(ReceivingBooks, ReceivingBooks.count_date_with_book, date_from, date_to)
+        archived = loans_export_query(ArchivedLoan, archived_loan_days, date_from, date_to)
 
-        students = session.execute(query).fetchmany(10)
+        if debtors_only:
+            current = current.where(ReceivingBooks.debt_condition())
+            archived = archived.where(archived_late_return)
 
-        return students
+        # ORDER BY on the compound merges the two index-ordered arms, there is no sort of the whole history
+        query = union_all(current, archived).order_by('date_of_issue').execution_options(yield_per=batch_size)
+        return session.execute(query)
+
+    @classmethod
+    def most_reading_students(
+            cls,
+            cur_year: int,
+            raw: bool = False
+    ) -> Union[Sequence[Tuple['Student', int]], Sequence[RowMapping]]:
+        """(Student, read_books) rows, or with raw=True mappings of the student columns plus read_books"""
+        query = most_reading_students_query(raw)
+        params = {'start': date(cur_year, 1, 1), 'end': date(cur_year + 1, 1, 1)}
+
+        if raw:
+            return session.execute(query, params).mappings().all()
+        return session.execute(query, params).all()
 
     @classmethod
     def return_book(cls, book: int, student: int) -> Tuple[str, int]:
-        try:
-            query = select(
-                ReceivingBooks
-            ).where(
-                ReceivingBooks.book_id == book,
-                ReceivingBooks.student_id == student,
+        returned = session.execute(
+            close_loan_query,
+            {'return_book_id': book, 'return_student_id': student, 'returned_at': datetime.now()}
+        ).rowcount
+
+        if not returned:
+            session.rollback()
+            return f'Student {student} did not take book {book}', 404
+        if returned > 1:
+            session.rollback()
+            return f'Found more than one entry with input (book={book}, student={student})', 400
+
+        session.execute(checkin_query, {'checkin_book_id': book, 'returned': 1})
+        session.commit()
+
+        return f'Book with id {book} was returned', 200
+
+    @classmethod
+    def add_receipts(cls, pairs: Sequence[Tuple[int, int]]) -> List[Dict[str, Any]]:
+        """Issues many (book, student) pairs in one transaction, every pair gets its own result"""
+        if not pairs:
+            return list()
+
+        book_ids = {book for book, _ in pairs}
+        open_pairs = {
+            (book, student)
+            for book, student in session.execute(
+                select(ReceivingBooks.book_id, ReceivingBooks.student_id).where(
+                    ReceivingBooks.book_id.in_(book_ids),
+                    ReceivingBooks.student_id.in_({student for _, student in pairs}),
+                    ReceivingBooks.date_of_return == None
+                )
+            )
+        }
+        available = {
+            book_id: count
+            for book_id, count in session.execute(
+                select(books.c.book_id, books.c.available).where(books.c.book_id.in_(book_ids))
+            )
+        }
+
+        results = list()
+        taken = Counter()
+        new_receipts = list()
+        now = datetime.now()
+
+        for book, student in pairs:
+            if (book, student) in open_pairs:
+                message, status = f'A student with id {student} has already taken a book with id {book}', 400
+            elif available.get(book, 0) - taken[book] <= 0:
+                message, status = f'There are no available copies of the book with id {book}', 400
+            else:
+                message, status = f'Book with id {book} issued to student {student}', 201
+                open_pairs.add((book, student))
+                taken[book] += 1
+                new_receipts.append({'book_id': book, 'student_id': student, 'date_of_issue': now})
+
+            results.append({'book_id': book, 'student_id': student, 'message': message, 'status': status})
+
+        if new_receipts:
+            updated = session.execute(
+                checkout_query,
+                [{'checkout_book_id': book, 'taken': count} for book, count in taken.items()]
+            ).rowcount
+
+            if updated != len(taken):
+                # A concurrent checkout took the copies counted above, settle every pair on its own instead
+                session.rollback()
+                return cls._one_by_one(cls.add_receipt, pairs)
+
+            if session.execute(new_receipt_query, new_receipts).rowcount != len(new_receipts):
+                session.rollback()
+                return cls._one_by_one(cls.add_receipt, pairs)
+
+        session.commit()
+
+        return results
+
+    @classmethod
+    def return_books(cls, pairs: Sequence[Tuple[int, int]]) -> List[Dict[str, Any]]:
+        """Closes the open loans for many (book, student) pairs in one transaction"""
+        if not pairs:
+            return list()
+
+        open_loans = defaultdict(list)
+        for receipt_id, book, student in session.execute(
+            select(ReceivingBooks.receipt_id, ReceivingBooks.book_id, ReceivingBooks.student_id).where(
+                ReceivingBooks.book_id.in_({book for book, _ in pairs}),
+                ReceivingBooks.student_id.in_({student for _, student in pairs}),
                 ReceivingBooks.date_of_return == None
             )
-            session.scalars(query).one()
+        ):
+            open_loans[(book, student)].append(receipt_id)
+
+        results = list()
+        returned = Counter()
+        closed_receipts = list()
+        now = datetime.now()
+
+        for book, student in pairs:
+            receipts = open_loans.pop((book, student), None)
+            if not receipts:
+                message, status = f'Student {student} did not take book {book}', 404
+            elif len(receipts) > 1:
+                message, status = f'Found more than one entry with input (book={book}, student={student})', 400
+            else:
+                message, status = f'Book with id {book} was returned', 200
+                returned[book] += 1
+                closed_receipts.append({'closed_receipt_id': receipts[0], 'returned_at': now})
+
+            results.append({'book_id': book, 'student_id': student, 'message': message, 'status': status})
+
+        if closed_receipts:
+            if session.execute(close_receipt_query, closed_receipts).rowcount != len(closed_receipts):
+                session.rollback()
+                return cls._one_by_one(cls.return_book, pairs)
+
+            session.execute(
+                checkin_query,
+                [{'checkin_book_id': book, 'returned': count} for book, count in returned.items()]
+            )
+
+        session.commit()
+
+        return results
 
-            update_query = update(ReceivingBooks).where(
-                ReceivingBooks.book_id == book,
-                ReceivingBooks.student_id == student
-            ).values(date_of_return=datetime.now())
+    @staticmethod
+    def _one_by_one(action, pairs: Sequence[Tuple[int, int]]) -> List[Dict[str, Any]]:
+        results = list()
+        for book, student in pairs:
+            message, status = action(book, student)
+            results.append({'book_id': book, 'student_id': student, 'message': message, 'status': status})
+        return results
 
-            session.execute(update_query)
+    @classmethod
+    def archive_closed_loans(
+            cls,
+            older_than_days: int = ARCHIVE_AFTER_DAYS,
+            batch_size: int = ARCHIVE_BATCH_SIZE
+    ) -> int:
+        """Moves loans returned more than older_than_days ago to the archive, returns how many were moved.
+        Every batch is its own transaction, checkouts get the write lock between them."""
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+        archived = 0
+        after = 0
+
+        while True:
+            receipt_ids = session.scalars(
+                archive_candidates_query,
+                {'after': after, 'cutoff': cutoff, 'batch_size': batch_size}
+            ).all()
+            if not receipt_ids:
+                return archived
+
+            session.execute(archive_loans_query, {'receipt_ids': receipt_ids})
+            session.execute(delete_archived_query, {'receipt_ids': receipt_ids})
             session.commit()
 
-            return f'Book with id {book} was returned', 200
-        except NoResultFound:
-            return f'Student {student} did not take book {book}', 404
-        except MultipleResultsFound:
-            return f'Found more than one entry with input (book={book}, student={student})', 400
+            archived += len(receipt_ids)
+            after = receipt_ids[-1]
 
     def to_json(self) -> Dict[str, Any]:
         return {col.name: getattr(self, col.name) for col in self.__table__.columns}
+
+
+closed_loan_days = func.julianday(ReceivingBooks.date_of_return) - func.julianday(ReceivingBooks.date_of_issue)
+
+# Expression index: SQLite uses it for predicates spelled exactly as closed_loan_days
+Index('ix_receiving_books_closed_loan_days', closed_loan_days)
+
+# Late returns in receipt id order for debtor_loans. DEBT_DAYS is inlined rather than bound,
+# SQLite only picks a partial index when the query repeats its WHERE term literally
+late_return = closed_loan_days > literal_column(str(DEBT_DAYS))
+archived_late_return = archived_loan_days > literal_column(str(DEBT_DAYS))
+Index('ix_receiving_books_late_returns', ReceivingBooks.receipt_id, sqlite_where=late_return)
+Index('ix_receiving_books_archive_late_returns', ArchivedLoan.receipt_id, sqlite_where=archived_late_return)
+
+# Circulation statements are built once, calls only bind parameters. A prebuilt statement also keeps
+# its memoized cache key, so SQLAlchemy finds the compiled SQL without walking the construct again.
+# Bind names differ from the column names, update() reserves those for its SET clause.
+# Checkout statement: a new open loan, or nothing when the pair already has one (rowcount 0)
+new_receipt_query = sqlite_insert(ReceivingBooks.__table__).on_conflict_do_nothing(
+    index_elements=[ReceivingBooks.book_id, ReceivingBooks.student_id],
+    index_where=ReceivingBooks.date_of_return.is_(None)
+)
+
+checkout_query = update(books).where(
+    books.c.book_id == bindparam('checkout_book_id'),
+    books.c.available >= bindparam('taken')
+).values(available=books.c.available - bindparam('taken'))
+
+checkin_query = update(books).where(
+    books.c.book_id == bindparam('checkin_book_id')
+).values(available=books.c.available + bindparam('returned'))
+
+close_loan_query = update(ReceivingBooks.__table__).where(
+    ReceivingBooks.book_id == bindparam('return_book_id'),
+    ReceivingBooks.student_id == bindparam('return_student_id'),
+    ReceivingBooks.date_of_return == None
+).values(date_of_return=bindparam('returned_at'))
+
+close_receipt_query = update(ReceivingBooks.__table__).where(
+    ReceivingBooks.receipt_id == bindparam('closed_receipt_id'),
+    ReceivingBooks.date_of_return == None
+).values(date_of_return=bindparam('returned_at'))
+
+
+# Archive statements. The newest loan never leaves: SQLite hands out the highest rowid again once it is deleted,
+# and a receipt id already in the archive must not come back for a new loan. Rollup triggers do not fire on
+# DELETE, the daily statistics keep counting archived loans.
+archive_candidates_query = select(ReceivingBooks.receipt_id).where(
+    ReceivingBooks.receipt_id > bindparam('after'),
+    ReceivingBooks.date_of_return < bindparam('cutoff'),
+    ReceivingBooks.receipt_id < select(func.max(ReceivingBooks.receipt_id)).scalar_subquery()
+).order_by(
+    ReceivingBooks.receipt_id
+).limit(bindparam('batch_size'))
+
+archive_loans_query = insert(ArchivedLoan.__table__).from_select(
+    [col.name for col in ReceivingBooks.__table__.columns],
+    select(ReceivingBooks.__table__).where(ReceivingBooks.receipt_id.in_(bindparam('receipt_ids', expanding=True)))
+)
+
+delete_archived_query = delete(ReceivingBooks.__table__).where(
+    ReceivingBooks.receipt_id.in_(bindparam('receipt_ids', expanding=True))
+)
+
+
+def loans_export_query(loans: Any, days: ColumnElement, date_from: Optional[date], date_to: Optional[date]) -> Select:
+    """One arm of loans_export, loans is ReceivingBooks or ArchivedLoan"""
+    query = select(
+        loans.receipt_id,
+        loans.date_of_issue,
+        loans.date_of_return,
+        func.round(days, 1).label('days_with_book'),
+        Student.student_id,
+        Student.name.label('student_name'),
+        Student.surname.label('student_surname'),
+        Student.email,
+        Student.phone,
+        books.c.book_id,
+        books.c.name.label('book_title'),
+        (Author.name + ' ' + Author.surname).label('author')
+    ).join(
+        Student,
+        Student.student_id == loans.student_id
+    ).join(
+        books,
+        books.c.book_id == loans.book_id
+    ).outerjoin(
+        Author,
+        Author.author_id == books.c.author_id
+    )
+
+    if date_from is not None:
+        query = query.where(loans.date_of_issue >= datetime.combine(date_from, time()))
+    if date_to is not None:
+        query = query.where(loans.date_of_issue < datetime.combine(date_to + timedelta(days=1), time()))
+    return query
+
+
+def month_bounds(year: int, month: int) -> Tuple[date, date]:
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start, end
+
+
+event.listen(ReceivingBooks.__table__, 'after_create', create_rollup_triggers)
@@ -0,0 +1,117 @@
+from datetime import date
+from functools import lru_cache
+from typing import Any, Sequence
+
+from sqlalchemy import Select, bindparam, desc, func, inspect, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Mapped, mapped_column
+
+from module_21_orm_2.homework.app.models.changes import mark_written
+from module_21_orm_2.homework.app.models.init import Base, session
+from module_21_orm_2.homework.app.models.student import Student
+
+# Triggers on receiving_books keep the rollup current for every insert and return, ORM or bulk Core alike.
+# A loan is counted on the day it was issued, its return is added to that same day.
+ROLLUP_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS receiving_stats_after_insert AFTER INSERT ON receiving_books BEGIN "
+    "INSERT INTO receiving_stats_daily(day, student_id, book_id, issues, returns) "
+    "VALUES (date(new.date_of_issue), new.student_id, new.book_id, 1, new.date_of_return IS NOT NULL) "
+    "ON CONFLICT (day, student_id, book_id) DO UPDATE SET "
+    "issues = issues + 1, returns = returns + excluded.returns; END",
+    "CREATE TRIGGER IF NOT EXISTS receiving_stats_after_return AFTER UPDATE OF date_of_return ON receiving_books "
+    "WHEN old.date_of_return IS NULL AND new.date_of_return IS NOT NULL BEGIN "
+    "UPDATE receiving_stats_daily SET returns = returns + 1 "
+    "WHERE day = date(new.date_of_issue) AND student_id = new.student_id AND book_id = new.book_id; END",
+)
+ROLLUP_REBUILD = (
+    "DELETE FROM receiving_stats_daily",
+    "INSERT INTO receiving_stats_daily(day, student_id, book_id, issues, returns) "
+    "SELECT date(date_of_issue), student_id, book_id, count(*), count(date_of_return) "
+    "FROM receiving_books GROUP BY 1, 2, 3",
+)
+# Archived loans left receiving_books without touching the rollup, a rebuild counts them back in
+ROLLUP_REBUILD_WITH_ARCHIVE = (
+    ROLLUP_REBUILD[0],
+    "INSERT INTO receiving_stats_daily(day, student_id, book_id, issues, returns) "
+    "SELECT date(date_of_issue), student_id, book_id, count(*), count(date_of_return) FROM ("
+    "SELECT date_of_issue, student_id, book_id, date_of_return FROM receiving_books UNION ALL "
+    "SELECT date_of_issue, student_id, book_id, date_of_return FROM receiving_books_archive"
+    ") GROUP BY 1, 2, 3",
+)
+
+
+class ReceivingStats(Base):
+    """Issues and returns per (day, student, book), so monthly and yearly statistics
+    read the rows of the requested days instead of every receipt"""
+    __tablename__ = 'receiving_stats_daily'
+
+    day: Mapped[date] = mapped_column(primary_key=True)
+    student_id: Mapped[int] = mapped_column(primary_key=True)
+    book_id: Mapped[int] = mapped_column(primary_key=True)
+    issues: Mapped[int] = mapped_column(default=0)
+    returns: Mapped[int] = mapped_column(default=0)
+
+    @classmethod
+    def backfill(cls) -> int:
+        """Recomputes the rollup from receiving_books, returns the number of rollup rows"""
+        connection = session.connection()
+        for statement in rollup_rebuild(connection):
+            connection.exec_driver_sql(statement)
+        mark_written(connection, cls.__tablename__)
+        rows = connection.exec_driver_sql('SELECT count(*) FROM receiving_stats_daily').scalar()
+        session.commit()
+        return rows
+
+
+# Statistics over the rollup rows of days in [start, end)
+issues_per_student = select(
+    func.sum(ReceivingStats.issues).label('row_count')
+).where(
+    ReceivingStats.day >= bindparam('start'),
+    ReceivingStats.day < bindparam('end')
+).group_by(
+    ReceivingStats.student_id
+).subquery()
+
+avg_issues_query = select(func.avg(issues_per_student.c.row_count))
+
+
+@lru_cache(maxsize=None)
+def most_reading_students_query(raw: bool) -> Select:
+    return select(
+        Student.__table__ if raw else Student,
+        func.sum(ReceivingStats.issues).label('read_books')
+    ).join(
+        ReceivingStats,
+        ReceivingStats.student_id == Student.student_id
+    ).where(
+        ReceivingStats.day >= bindparam('start'),
+        ReceivingStats.day < bindparam('end')
+    ).group_by(
+        ReceivingStats.student_id
+    ).order_by(
+        desc('read_books'),
+        desc(func.sum(ReceivingStats.returns))
+    ).limit(10)
+
+
+def rollup_rebuild(connection: Connection) -> Sequence[str]:
+    # create_all may build receiving_books and the rollup before the archive table
+    if inspect(connection).has_table('receiving_books_archive'):
+        return ROLLUP_REBUILD_WITH_ARCHIVE
+    return ROLLUP_REBUILD
+
+
+def create_rollup_triggers(target, connection: Connection, **kw: Any) -> None:
+    """after_create listener of receiving_books, also run by migrations.upgrade for existing databases"""
+    is_new = not connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'receiving_stats_after_insert'"
+    ).scalar()
+
+    for statement in ROLLUP_DDL:
+        connection.exec_driver_sql(statement)
+
+    # receiving_books may be created before the rollup table, it is empty then and there is nothing to backfill
+    if is_new and inspect(connection).has_table(ReceivingStats.__tablename__):
+        for statement in rollup_rebuild(connection):
+            connection.exec_driver_sql(statement)
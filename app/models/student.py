@@ -1,13 +1,22 @@
+import json
 import re
-from csv import DictReader
-from typing import Dict, Any, Union, Optional, List
+from functools import lru_cache
+from typing import Dict, Any, Union, Optional, List, Iterable, Callable, Tuple
 
-from sqlalchemy import Text, select, UniqueConstraint, event
+from sqlalchemy import Select, Text, UniqueConstraint, and_, bindparam, event, func, select, union
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.associationproxy import association_proxy, AssociationProxy
-from sqlalchemy.orm import relationship, Mapped, mapped_column
+from sqlalchemy.orm import relationship, Mapped, mapped_column, selectinload
 
 from module_21_orm_2.homework.app.models.init import Base, session
 
+IMPORT_BATCH_SIZE = 1000
+# What an import does with a row whose email or name, surname and phone already belong to a student
+IMPORT_MODES = ('skip', 'update')
+IMPORTED_COLUMNS = ('name', 'surname', 'phone', 'email', 'average_score', 'scholarship')
+PHONE_PATTERN = re.compile(r'\+79\d{9}')
+EMAIL_PATTERN = re.compile(r'^[^@]+@[^@]+\.[^@]+$')
+
 
 class Student(Base):
     __tablename__ = 'students'
@@ -24,7 +33,7 @@ class Student(Base):
         'ReceivingBooks',
         back_populates='student',
         cascade='all',
-        lazy='subquery'
+        lazy='raise_on_sql'
     )
 
     books_titles: AssociationProxy[List[str]] = association_proxy(
@@ -60,18 +69,122 @@ class Student(Base):
                 "\n)")
 
     @classmethod
-    def add_students_from_csv(cls, data: Union[DictReader, list]) -> None:
-        session.bulk_insert_mappings(Student, data)
+    def add_students_from_csv(
+            cls,
+            rows: Iterable[Dict[str, str]],
+            batch_size: int = IMPORT_BATCH_SIZE,
+            progress: Optional[Callable[[Dict[str, int]], None]] = None,
+            on_conflict: str = 'skip'
+    ) -> Dict[str, int]:
+        """Imports valid rows and reports how many were inserted, updated, skipped or rejected as invalid.
+        Rows repeating a student of an earlier row are skipped, existing students are skipped or updated
+        depending on on_conflict, so importing the same file twice changes nothing.
+        progress, when given, gets the running report after every committed batch."""
+        if on_conflict not in IMPORT_MODES:
+            raise ValueError(f'on_conflict must be one of {", ".join(IMPORT_MODES)}')
+
+        report = {'inserted': 0, 'updated': 0, 'skipped': 0, 'rejected': 0}
+        seen_emails = set()
+        seen_identities = set()
+        batch = list()
+
+        for row in rows:
+            try:
+                student = cls.mapping_from_csv_row(row)
+            except (KeyError, TypeError, ValueError):
+                report['rejected'] += 1
+                continue
+
+            identity = identity_of(student)
+            if student['email'] in seen_emails or identity in seen_identities:
+                report['skipped'] += 1
+                continue
+            seen_emails.add(student['email'])
+            seen_identities.add(identity)
+
+            batch.append(student)
+            if len(batch) >= batch_size:
+                cls._import_batch(batch, report, on_conflict)
+                batch = list()
+                if progress:
+                    progress(report)
+
+        if batch:
+            cls._import_batch(batch, report, on_conflict)
+        if progress:
+            progress(report)
+
+        return report
+
+    @classmethod
+    def _import_batch(cls, batch: List[Dict[str, Any]], report: Dict[str, int], on_conflict: str) -> None:
+        # Students already holding one of the keys of the batch, fetched in one query
+        existing = session.execute(existing_students_query, {
+            'emails': [student['email'] for student in batch],
+            'identities': json.dumps([identity_of(student) for student in batch])
+        }).mappings().all()
+        by_email = {row['email']: row for row in existing}
+        by_identity = {identity_of(row): row for row in existing}
+
+        new_students = list()
+        updates_by_email = list()
+        updates_by_identity = list()
+
+        for student in batch:
+            same_email = by_email.get(student['email'])
+            same_identity = by_identity.get(identity_of(student))
+            current = same_email or same_identity
+
+            if current is None:
+                new_students.append(student)
+            elif on_conflict == 'skip':
+                report['skipped'] += 1
+            elif same_email and same_identity and same_email['student_id'] != same_identity['student_id']:
+                # The email and the name with phone belong to two different students
+                report['rejected'] += 1
+            elif all(current[column] == student[column] for column in IMPORTED_COLUMNS):
+                report['skipped'] += 1
+            elif same_email:
+                updates_by_email.append(student)
+            else:
+                updates_by_identity.append(student)
+
+        if new_students:
+            # Students added since the keys were fetched are skipped by ON CONFLICT DO NOTHING
+            inserted = session.execute(new_students_query, new_students).rowcount
+            report['inserted'] += inserted
+            report['skipped'] += len(new_students) - inserted
+        if updates_by_email:
+            session.execute(upsert_by_email_query, updates_by_email)
+            report['updated'] += len(updates_by_email)
+        if updates_by_identity:
+            session.execute(upsert_by_identity_query, updates_by_identity)
+            report['updated'] += len(updates_by_identity)
+
         session.commit()
 
+    @staticmethod
+    def mapping_from_csv_row(row: Dict[str, str]) -> Dict[str, Any]:
+        phone = check_phone(row['phone'])
+        email = check_email(row['email'])
+
+        return {
+            'name': row['name'],
+            'surname': row['surname'],
+            'phone': phone,
+            'email': email,
+            'average_score': float(row['average_score']),
+            'scholarship': row['scholarship'] == 'True'
+        }
+
     @classmethod
     def add_new_student(cls, student: 'Student') -> None:
         session.add(student)
         session.commit()
 
     @classmethod
-    def student_by_id(cls, student_id) -> Optional['Student']:
-        return session.scalar(select(Student).where(Student.student_id == student_id))
+    def student_by_id(cls, student_id, with_books: bool = False) -> Optional['Student']:
+        return session.scalar(student_query(with_books), {'student_id': student_id})
 
     @classmethod
     def students_with_dormitory(cls) -> Union[List['Student'], str]:
@@ -91,16 +204,66 @@ class Student(Base):
         return {col.name: getattr(self, col.name) for col in self.__table__.columns}
 
 
+def identity_of(student: Dict[str, Any]) -> Tuple[str, str, str]:
+    """The student_unique_key of a row"""
+    return student['name'], student['surname'], student['phone']
+
+
+def upsert_query(*key: str):
+    """INSERT ... ON CONFLICT (key) DO UPDATE of every imported column"""
+    query = sqlite_insert(Student.__table__)
+    return query.on_conflict_do_update(
+        index_elements=key,
+        set_={column: query.excluded[column] for column in IMPORTED_COLUMNS}
+    )
+
+
+# Bound with the emails of a batch and its identities as a JSON array of [name, surname, phone] arrays.
+# SQLite scans the table for a row-value IN list, joined to json_each it searches student_unique_key per key.
+_identity_keys = func.json_each(bindparam('identities')).table_valued('value')
+existing_students_query = union(
+    select(Student.__table__).where(Student.email.in_(bindparam('emails', expanding=True))),
+    select(Student.__table__).join(_identity_keys, and_(
+        Student.name == func.json_extract(_identity_keys.c.value, '$[0]'),
+        Student.surname == func.json_extract(_identity_keys.c.value, '$[1]'),
+        Student.phone == func.json_extract(_identity_keys.c.value, '$[2]')
+    ))
+)
+
+new_students_query = sqlite_insert(Student.__table__).on_conflict_do_nothing()
+upsert_by_email_query = upsert_query('email')
+upsert_by_identity_query = upsert_query('name', 'surname', 'phone')
+
+
+@lru_cache(maxsize=None)
+def student_query(with_books: bool) -> Select:
+    """Built on first use: the loader options need the ReceivingBooks mapper, which imports this module"""
+    query = select(Student).where(Student.student_id == bindparam('student_id'))
+    if with_books:
+        # books_titles and books_author read through both hops.
+        # ReceivingBooks imports this module, so it is reached through the relationship
+        receipt = Student.books.property.mapper.class_
+        query = query.options(selectinload(Student.books).joinedload(receipt.book))
+    return query
+
+
+def check_phone(phone: str) -> str:
+    if not PHONE_PATTERN.match(phone):
+        raise ValueError(f'Invalid phone number: {phone}.\nEnter the number in the format +79*********')
+    return phone
+
+
+def check_email(email: str) -> str:
+    if not EMAIL_PATTERN.match(email):
+        raise ValueError(f"Invalid email address: {email}. It must be a valid email format.")
+    return email.lower()
+
+
 @event.listens_for(Student, 'before_insert')
 def validate_phone(mapper, connection, target):
-    phone = target.phone
-    if not re.match(r'\+79\d{9}', phone):
-        raise ValueError(f'Invalid phone number: {phone}.\nEnter the number in the format +79*********')
+    check_phone(target.phone)
 
 
 @event.listens_for(Student, 'before_insert')
 def validate_and_format_email(mapper, connection, target):
-    email = target.email
-    if not re.match(r'^[^@]+@[^@]+\.[^@]+$', email):
-        raise ValueError(f"Invalid email address: {email}. It must be a valid email format.")
-    target.email = email.lower()
+    target.email = check_email(target.email)
@@ -1,23 +1,42 @@
 import csv
-import os
-from datetime import datetime
-from pathlib import Path
-
-from flask import Flask, jsonify, request
+import io
+import shutil
+from datetime import MAXYEAR, MINYEAR, date, datetime
+from functools import partial, wraps
+from tempfile import SpooledTemporaryFile
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import click
+from flask import Flask, Response, jsonify, make_response, request, stream_with_context
+from sqlalchemy.engine import Result
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
-from werkzeug.utils import secure_filename
 
-from module_21_orm_2.homework.app.models.init import Base, engine
+from module_21_orm_2.homework.app.jobs import Job, QueueFull, import_jobs
+from module_21_orm_2.homework.app.metrics import QueryMetrics
+from module_21_orm_2.homework.app.models.init import engine, read_engine, session
 from module_21_orm_2.homework.app.models.prepare_data import insert_data
-from module_21_orm_2.homework.app.models.book import Book
+from module_21_orm_2.homework.app.models.book import Book, SEARCH_LIMIT
+from module_21_orm_2.homework.app.models.cache import analytics_cache
+from module_21_orm_2.homework.app.models.catalogue import catalogue
+from module_21_orm_2.homework.app.models.loan_archive import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+from module_21_orm_2.homework.app.models.migrations import init_database
 from module_21_orm_2.homework.app.models.receiving_books import ReceivingBooks
-from module_21_orm_2.homework.app.models.student import Student
+from module_21_orm_2.homework.app.models.receiving_stats import ReceivingStats
+from module_21_orm_2.homework.app.models.student import Student, IMPORT_MODES
+from module_21_orm_2.homework.app.serializers import dumps, json_response
+from module_21_orm_2.homework.app.web import Validators, page_args
 
-UPLOAD_FOLDER = Path('downloads/')
 ALLOWED_EXTENSIONS = {'csv'}
+MAX_CIRCULATION_BATCH = 10000
+CSV_DELIMITER = ';'
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['IMPORT_BATCH_SIZE'] = 1000
+# Uploads up to this size stay in memory while they wait for an import worker, bigger ones go to disk
+app.config['IMPORT_SPOOL_SIZE'] = 8 * 1024 * 1024
+
+query_metrics = QueryMetrics(engines={engine, read_engine})
+query_metrics.init_app(app)
 
 
 def allowed_file(filename) -> bool:
@@ -25,38 +44,199 @@ def allowed_file(filename) -> bool:
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def circulation_pairs() -> List[Tuple[int, int]]:
+    """Reads a JSON array of {"book_id": ..., "student_id": ...} objects, raises ValueError on bad input"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array of {"book_id": ..., "student_id": ...} objects')
+    if len(data) > MAX_CIRCULATION_BATCH:
+        raise ValueError(f'At most {MAX_CIRCULATION_BATCH} pairs can be sent at once')
+
+    try:
+        return [(int(pair['book_id']), int(pair['student_id'])) for pair in data]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Every pair needs integer book_id and student_id')
+
+
+def date_range_args() -> Tuple[Optional[date], Optional[date]]:
+    """Reads date_from and date_to as YYYY-MM-DD, raises ValueError on bad input"""
+    bounds = list()
+    for name in ('date_from', 'date_to'):
+        value = request.args.get(name)
+        try:
+            bounds.append(date.fromisoformat(value) if value else None)
+        except ValueError:
+            raise ValueError(f'{name} must be a date in YYYY-MM-DD format')
+
+    date_from, date_to = bounds
+    if date_from and date_to and date_from > date_to:
+        raise ValueError('date_from must not be later than date_to')
+    return date_from, date_to
+
+
+def stream_requested() -> bool:
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def stream_json_list(key: str, query_rows: Callable[[], Result]) -> Response:
+    # The query runs inside the generator: the session of the view itself is closed before the body is sent
+    read_only = session.info.get('read_only', False)
+
+    def generate() -> Iterator[bytes]:
+        session.info['read_only'] = read_only
+        yield b'{' + dumps(key) + b':['
+        separator = b''
+        for partition in query_rows().partitions():
+            # Whole batch in one dumps call, minus the list brackets
+            yield separator + dumps(partition)[1:-1]
+            separator = b','
+        yield b']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def stream_csv(filename: str, query_rows: Callable[[], Result]) -> Response:
+    """CSV download with a header row, written one cursor partition at a time"""
+    read_only = session.info.get('read_only', False)
+
+    def generate() -> Iterator[str]:
+        session.info['read_only'] = read_only
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=CSV_DELIMITER)
+
+        rows = query_rows()
+        writer.writerow(rows.keys())
+        for partition in rows.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+def conditional(*tables: str, varies: Callable[[], Tuple] = tuple):
+    """Tags responses with the versions of tables and answers 304 Not Modified without running the view
+    while they are unchanged since the client's copy. varies gives the other inputs of the response."""
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def wrapper(*args: Any, **kwargs: Any) -> Response:
+            validators = Validators(tables, varies())
+            if validators.client_is_current(request.headers):
+                return validators.tag(Response(status=304))
+            return validators.tag(make_response(view(*args, **kwargs)))
+
+        return wrapper
+
+    return decorator
+
+
+def import_students(upload: BinaryIO, job: Job, batch_size: int, on_conflict: str) -> Dict[str, int]:
+    with upload:
+        student_file = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+        reader = csv.DictReader(student_file, delimiter=CSV_DELIMITER)
+        return Student.add_students_from_csv(
+            reader,
+            batch_size=batch_size,
+            progress=job.progress,
+            on_conflict=on_conflict
+        )
+
+
+def most_popular_book_as_dict() -> Optional[Dict[str, Any]]:
+    most_popular = Book.most_popular_book()
+    if not most_popular:
+        return None
+
+    book_data, rec_count = most_popular
+    most_popular_book = book_data.to_json()
+    most_popular_book['rec_count'] = rec_count
+    return most_popular_book
+
+
+def most_reading_students_as_dicts(cur_year: int) -> List[Dict[str, Any]]:
+    return [dict(student) for student in ReceivingBooks.most_reading_students(cur_year=cur_year, raw=True)]
+
+
+@app.before_request
+def route_reads() -> None:
+    # GET handlers only read, they go to the read-only engine and never wait for a checkout
+    session.info['read_only'] = request.method in ('GET', 'HEAD')
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None) -> None:
+    try:
+        if exception is None and session.is_active:
+            session.commit()
+        else:
+            session.rollback()
+    finally:
+        session.remove()
+
+
 @app.route('/library/get_all', methods=['GET'])
+@conditional('books')
 def get_all_books():
-    books = Book.all_books()
+    limit, after = page_args(request.args)
 
-    if books:
-        return jsonify(
-            book_list=[book.to_json() for book in books]
+    if stream_requested():
+        return stream_json_list('book_list', lambda: Book.stream_books(after=after))
+
+    if catalogue.enabled:
+        books = catalogue.all_books(limit=limit, after=after)
+    else:
+        books = Book.all_books(limit=limit, after=after, raw=True)
+
+    # A full last page still gives a cursor, the page after it is empty rather than missing
+    if books or after is not None:
+        return json_response(
+            book_list=books,
+            next_after=books[-1]['book_id'] if len(books) == limit else None
         ), 200
     else:
         return 'There are no books in the library', 404
 
 
 @app.route('/library/avg_count_of_receiving_books', methods=['GET'])
+@conditional('receiving_books', 'receiving_stats_daily', varies=lambda: (date.today(),))
 def get_avg_count():
     cur_date = datetime.now()
     cur_date_str = cur_date.strftime("%d-%m-%Y")
+    month = request.args.get('month', default=cur_date.month, type=int)
+    year = request.args.get('year', default=cur_date.year, type=int)
 
-    avg_count = ReceivingBooks.avg_count_of_receiving_books(cur_date.month)
+    if not 1 <= month <= 12 or not MINYEAR <= year < MAXYEAR:
+        return 'month must be between 1 and 12 and year a valid calendar year', 400
+
+    avg_count = analytics_cache.get_or_set(
+        ('avg_count_of_receiving_books', year, month),
+        ('receiving_books', 'receiving_stats_daily'),
+        lambda: ReceivingBooks.avg_count_of_receiving_books(month, year)
+    )
 
     if avg_count:
         return (
-            'Average count of books students borrowed this month = {avg_count}'
+            'Average count of books students borrowed in {month:02d}-{year} = {avg_count}'
             '\nRequest date: {rec_date}'
         ).format(
+            month=month,
+            year=year,
             avg_count=round(avg_count, 2),
             rec_date=cur_date_str
         ), 200
     else:
         return (
-            'Students did not take books this month'
+            'Students did not take books in {month:02d}-{year}'
             '\nRequest date: {rec_date}'
         ).format(
+            month=month,
+            year=year,
             rec_date=cur_date_str
         ), 404
 
@@ -74,66 +254,153 @@ def get_book_recommendations():
         return recommendations_data
 
 
+@app.route('/library/book_recommendations', methods=['POST'])
+def get_batch_book_recommendations():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('student_ids'), list):
+        return 'Expected a JSON object with a student_ids list', 400
+
+    try:
+        student_ids = [int(student_id) for student_id in data['student_ids']]
+    except (TypeError, ValueError):
+        return 'Student IDs must be integers', 400
+
+    recommendations = Book.recommendations_for_students(student_ids)
+
+    return jsonify(
+        recommendations={
+            student_id: [book.to_json() for book in books]
+            for student_id, books in recommendations.items()
+        }
+    ), 200
+
+
 @app.route('/library/debtors', methods=['GET'])
 def get_debtors():
-    deb_list = ReceivingBooks.debtors_list()
+    limit, after = page_args(request.args)
 
-    if deb_list:
-        return jsonify(
-            list_of_debtors=[deb.to_json() for deb in deb_list]
+    if stream_requested():
+        return stream_json_list('list_of_debtors', lambda: ReceivingBooks.stream_debtors(after=after))
+
+    deb_list = ReceivingBooks.debtors_list(limit=limit, after=after, raw=True)
+
+    if deb_list or after is not None:
+        return json_response(
+            list_of_debtors=deb_list,
+            next_after=deb_list[-1]['receipt_id'] if len(deb_list) == limit else None
         )
     else:
         return 'No students failed their books', 404
 
 
+@app.route('/library/debtors.csv', methods=['GET'])
+def export_debtors():
+    try:
+        date_from, date_to = date_range_args()
+    except ValueError as exc:
+        return f'{exc}', 400
+
+    return stream_csv(
+        'debtors.csv',
+        lambda: ReceivingBooks.loans_export(date_from=date_from, date_to=date_to, debtors_only=True)
+    )
+
+
+@app.route('/library/loans.csv', methods=['GET'])
+def export_loans():
+    try:
+        date_from, date_to = date_range_args()
+    except ValueError as exc:
+        return f'{exc}', 400
+
+    return stream_csv('loans.csv', lambda: ReceivingBooks.loans_export(date_from=date_from, date_to=date_to))
+
+
 @app.route('/library/get_by_name', methods=['GET'])
+@conditional('books', 'authors')
 def get_books_by_title():
     title = request.args.get('title', type=str)
-    books = Book.book_by_name(title=title)
+    limit = request.args.get('limit', default=SEARCH_LIMIT, type=int)
+    if catalogue.enabled:
+        books = catalogue.book_by_name(title=title, limit=limit)
+    else:
+        books = Book.book_by_name(title=title, limit=limit, raw=True)
 
     if books:
-        return jsonify(
-            book_list=[book.to_json() for book in books]
-        ), 200
+        return json_response(book_list=books), 200
     else:
         return f'There is no book with title {title} in the library', 404
 
 
 @app.route('/library/most_popular_book', methods=['GET'])
+@conditional('books', 'students', 'receiving_books', 'receiving_stats_daily')
 def get_most_popular_book():
-    book_data, rec_count = Book.most_popular_book()
-    if book_data:
-        most_popular_book = book_data.to_json()
-        most_popular_book['rec_count'] = rec_count
-
+    most_popular_book = analytics_cache.get_or_set(
+        'most_popular_book',
+        ('books', 'students', 'receiving_books', 'receiving_stats_daily'),
+        most_popular_book_as_dict
+    )
+    if most_popular_book:
         return jsonify(most_popular_book=most_popular_book), 200
     else:
         return 'There are no books in the library yet', 404
 
 
 @app.route('/library/most_reading_students', methods=['GET'])
+@conditional('students', 'receiving_books', 'receiving_stats_daily', varies=lambda: (date.today().year,))
 def get_most_reading_students():
-    cur_date = datetime.now()
-    students = list()
+    year = request.args.get('year', default=datetime.now().year, type=int)
 
-    for student, read_books in ReceivingBooks.most_reading_students(cur_year=cur_date.year):
-        student_as_dict = student.to_json()
-        student_as_dict['read_books'] = read_books
-        students.append(student_as_dict)
+    if not MINYEAR <= year < MAXYEAR:
+        return 'year must be a valid calendar year', 400
+
+    students = analytics_cache.get_or_set(
+        ('most_reading_students', year),
+        ('students', 'receiving_books', 'receiving_stats_daily'),
+        lambda: most_reading_students_as_dicts(year)
+    )
 
     if students:
-        return jsonify(most_reading_students=students), 200
+        return json_response(most_reading_students=students), 200
     else:
         return 'There are no students data in the database yet', 404
 
 
+@app.route('/library/cache_stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(analytics_cache=analytics_cache.stats(), catalogue=catalogue.stats()), 200
+
+
+@app.route('/library/catalogue_check', methods=['GET', 'POST'])
+def check_catalogue():
+    # The snapshot lives in this process, so only the server itself can compare it. POST also repairs it
+    if not catalogue.enabled:
+        return 'The catalogue snapshot is disabled', 404
+    return jsonify(catalogue.verify(repair=request.method == 'POST')), 200
+
+
+@app.route('/library/backfill_stats', methods=['POST'])
+def rebuild_stats():
+    # The commit publishes receiving_stats_daily, which drops the cached statistics and changes their ETags
+    return jsonify(rollup_rows=ReceivingStats.backfill()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(query_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/library/sum_of_books_by_author', methods=['GET'])
+@conditional('books')
 def get_sum_of_books_by_author():
     author_id = request.args.get('author_id', type=int)
-    sum_of_books = Book.sum_of_books_by_author_id(author_id=author_id)
+    if catalogue.enabled:
+        sum_of_books = catalogue.sum_of_books_by_author_id(author_id=author_id)
+    else:
+        sum_of_books = Book.sum_of_books_by_author_id(author_id=author_id)
 
     if sum_of_books:
-        return f'The author with id {author_id} has {sum_of_books} books in the library', 200
+        return f'The author with id {author_id} has {sum_of_books} books remaining in the library', 200
     else:
         return 'There are no books by this author in the library', 404
 
@@ -148,28 +415,34 @@ def add_students_from_file():
     if file.filename == '':
         return 'No selected file', 400
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
+    on_conflict = request.form.get('on_conflict', default='skip')
+    if on_conflict not in IMPORT_MODES:
+        return f'on_conflict must be one of {", ".join(IMPORT_MODES)}', 400
 
-        if not app.config['UPLOAD_FOLDER'].exists() or not app.config['UPLOAD_FOLDER'].is_dir():
-            os.mkdir(app.config['UPLOAD_FOLDER'])
-
-        file.save(app.config['UPLOAD_FOLDER'] / filename)
-        with open(Path(f'downloads/{filename}'), newline='') as student_file:
-            data = list()
-            reader = csv.DictReader(student_file, delimiter=';')
-
-            for row in reader:
-                row['scholarship'] = (row['scholarship'] == 'True')
-                data.append(row)
+    if file and allowed_file(file.filename):
+        # The request stream is gone once the view returns, the worker reads a spooled copy
+        upload = SpooledTemporaryFile(max_size=app.config['IMPORT_SPOOL_SIZE'])
+        shutil.copyfileobj(file.stream, upload)
+        upload.seek(0)
+
+        try:
+            job = import_jobs.submit('add_students_from_file', partial(
+                import_students, upload, batch_size=app.config['IMPORT_BATCH_SIZE'], on_conflict=on_conflict
+            ))
+        except QueueFull as exc:
+            upload.close()
+            return f'{exc}', 503, {'Retry-After': '5'}
+
+        return jsonify(**job.to_json(), status_url=f'/library/jobs/{job.job_id}'), 202
+    return 'Wrong file', 400
 
-            try:
-                Student.add_students_from_csv(data)
-            except (IntegrityError, PendingRollbackError):
-                return 'The students are already in database', 400
 
-        return 'Students added successfully', 201
-    return 'Wrong file', 400
+@app.route('/library/jobs/<job_id>', methods=['GET'])
+def get_job(job_id: str):
+    job = import_jobs.get(job_id)
+    if job is None:
+        return f'There is no job with id {job_id}', 404
+    return jsonify(job.to_json()), 200
 
 
 @app.route('/library/add_new_student', methods=['POST'])
@@ -204,6 +477,26 @@ def give_book():
     return res
 
 
+@app.route('/library/give_books', methods=['POST'])
+def give_books():
+    try:
+        pairs = circulation_pairs()
+    except ValueError as exc:
+        return f'{exc}', 400
+
+    return jsonify(results=ReceivingBooks.add_receipts(pairs)), 200
+
+
+@app.route('/library/return_books', methods=['POST'])
+def return_books():
+    try:
+        pairs = circulation_pairs()
+    except ValueError as exc:
+        return f'{exc}', 400
+
+    return jsonify(results=ReceivingBooks.return_books(pairs)), 200
+
+
 @app.route('/library/return_book', methods=['POST'])
 def return_book():
     book_id = request.form.get('book_id', type=int)
@@ -213,7 +506,43 @@ def return_book():
     return res
 
 
+@app.cli.command('init-db')
+def init_db() -> None:
+    """Creates and upgrades the schema"""
+    init_database()
+    click.echo('Database is up to date')
+
+
+@app.cli.command('seed')
+def seed() -> None:
+    """Creates the schema and fills an empty database with the demo library"""
+    init_database()
+    if insert_data():
+        click.echo('Demo data inserted')
+    else:
+        click.echo('The database already has data, nothing inserted')
+
+
+@app.cli.command('backfill-stats')
+def backfill_stats() -> None:
+    """Rebuilds the daily circulation rollup from receiving_books. A running server keeps serving its cached
+    statistics until their TTL, POST /library/backfill_stats rebuilds the rollup inside the server instead."""
+    click.echo(f'{ReceivingStats.backfill()} daily rollup rows written')
+
+
+@app.cli.command('archive-loans')
+@click.option('--days', type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive loans returned more than this many days ago')
+@click.option('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, show_default=True)
+def archive_loans(days: int, batch_size: int) -> None:
+    """Moves old returned loans from receiving_books to receiving_books_archive"""
+    archived = ReceivingBooks.archive_closed_loans(older_than_days=days, batch_size=batch_size)
+    click.echo(f'{archived} loans archived')
+
+
 if __name__ == '__main__':
-    Base.metadata.create_all(engine)
-    insert_data()
-    app.run(debug=False, port=8080)
+    # Startup only creates missing tables and indexes, demo data comes from `flask seed` (see README.md)
+    init_database()
+    if catalogue.enabled:
+        catalogue.load()
+    app.run(debug=False, port=8080, threaded=True)
@@ -0,0 +1,32 @@
+import json
+from datetime import date
+from typing import Any, Callable, Type
+
+from flask import Response
+from sqlalchemy.engine import RowMapping
+from werkzeug.http import http_date
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, RowMapping):
+        return dict(value)
+    if isinstance(value, date):
+        # Same format flask.jsonify uses for dates
+        return http_date(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(payload: Any) -> bytes:
+    """JSON bytes for plain data and Core row mappings, without building ORM objects first"""
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def json_responder(response_class: Type[Response]) -> Callable[..., Response]:
+    """json_response building another werkzeug Response subclass, as Quart's"""
+    def json_response(**payload: Any) -> Response:
+        return response_class(dumps(payload), mimetype='application/json')
+
+    return json_response
+
+
+json_response = json_responder(Response)
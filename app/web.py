@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Iterable, Mapping, Optional, Tuple
+
+from werkzeug.sansio.http import is_resource_modified
+from werkzeug.sansio.response import Response
+
+from module_21_orm_2.homework.app.models.cache import table_versions
+from module_21_orm_2.homework.app.models.init import PAGE_LIMIT
+
+# Request and response helpers shared by routes.py (Flask) and async_routes.py (Quart),
+# both hand werkzeug MultiDicts, headers and responses to them
+MAX_PAGE_LIMIT = 1000
+
+# Statuses that depend only on the tables of a conditional view, errors are never tagged
+TAGGED_STATUSES = (200, 304, 404)
+
+
+def page_args(args: Mapping) -> Tuple[int, Optional[int]]:
+    limit = args.get('limit', default=PAGE_LIMIT, type=int)
+    after = args.get('after', type=int)
+    return max(1, min(limit, MAX_PAGE_LIMIT)), after
+
+
+class Validators:
+    """ETag and Last-Modified of a response built from tables, varies holds its other inputs"""
+
+    def __init__(self, tables: Iterable[str], varies: Tuple = ()):
+        self.etag = table_versions.etag(tables, *varies)
+        # Table write times say nothing about varies, e.g. the default month rolling over, only the ETag covers it
+        self.last_modified: Optional[datetime] = None if varies else table_versions.last_modified(tables)
+
+    def client_is_current(self, headers: Mapping) -> bool:
+        """True when the client's copy matches, a 304 Not Modified answers the request then"""
+        return not is_resource_modified(
+            http_range=headers.get('Range'),
+            http_if_range=headers.get('If-Range'),
+            http_if_modified_since=headers.get('If-Modified-Since'),
+            http_if_none_match=headers.get('If-None-Match'),
+            http_if_match=headers.get('If-Match'),
+            etag=self.etag,
+            last_modified=self.last_modified
+        )
+
+    def tag(self, response: Response) -> Response:
+        if response.status_code in TAGGED_STATUSES:
+            response.set_etag(self.etag)
+            # Assigning None would stamp the current time, the header is left out instead
+            if self.last_modified is not None:
+                response.last_modified = self.last_modified
+            # Caches may keep the body but have to revalidate it on every use
+            response.cache_control.no_cache = True
+        return response